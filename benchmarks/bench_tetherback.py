@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+# End-to-end benchmarks against a fake device (see fakeadb.py): wall time, host
+# CPU time and throughput for build_partmap, a raw partition backup with each
+# transport, and complete runs of main(). Host CPU is that of this process (all
+# threads), not of the fake adb and device-side processes. Throughput is based on
+# the sizes of the partitions backed up.
+#
+#   python3 benchmarks/bench_tetherback.py [--scale MiB] [--bandwidth MB/s] [--latency SECS]
+#                                          [--gzip-rate MB/s] [--json FILE] [--compare FILE]
+#
+# Save the results of one run with --json, and compare a later run to it with --compare.
+
+import os, sys, json, time, shutil, argparse, resource, tempfile, contextlib
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tetherback import tetherback as tb
+from tetherback.adb_wrapper import AdbWrapper
+from fakedevice import make_device
+
+FAKEADB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakeadb.py')
+
+# complete backups: (name, command-line arguments)
+MAIN_RUNS = [
+    ('main: defaults', []),
+    ('main: -x -Z -j2', ['-x', '-Z', '-j2']),
+    ('main: -t --stripes 2', ['-t', '--stripes', '2']),
+    ('main: -N -x -I', ['-N', '-x', '-I']),
+]
+
+@contextlib.contextmanager
+def quiet(verbose=False):
+    # hide progress bars and messages, including those of child processes
+    if verbose:
+        yield
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    null = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(null, 1)
+        os.dup2(null, 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + (null,):
+            os.close(fd)
+
+def measure(fn, verbose=False):
+    r0, t0 = resource.getrusage(resource.RUSAGE_SELF), time.monotonic()
+    with quiet(verbose):
+        fn()
+    r1, t1 = resource.getrusage(resource.RUSAGE_SELF), time.monotonic()
+    return t1 - t0, (r1.ru_utime - r0.ru_utime) + (r1.ru_stime - r0.ru_stime)
+
+def bench_partmap(adb, session, repeat):
+    def run():
+        if session:
+            adb.start_session()
+        try:
+            for ii in range(repeat):
+                tb.build_partmap(adb)
+        finally:
+            adb.close_session()
+    return run
+
+def bench_transport(adb, partmap, transport, outdir, host_gzip=False):
+    pi = partmap['boot']
+    bp = tb.BackupPlan(os.path.join(outdir, 'boot.emmc.win'), None)
+    def run():
+        cmdline = tb.prepare_partition(adb, pi, bp, host_gzip=host_gzip)
+        tb.backup_partition(adb, pi, bp, transport, cmdline=cmdline, host_gzip=host_gzip)
+    return run
+
+def bench_main(argv, outdir):
+    def run():
+        cwd = os.getcwd()
+        try:
+            tb.main(['-o', outdir] + argv)
+        finally:
+            os.chdir(cwd)
+    return run
+
+def main(args=None):
+    p = argparse.ArgumentParser(description='Benchmark tetherback against a fake device')
+    p.add_argument('--scale', type=int, default=8, metavar='MiB', help='Size of the fake boot partition; others are multiples of it, for a total of 28x (default %(default)s MiB)')
+    p.add_argument('--bandwidth', type=float, default=0, metavar='MB/s', help='Device-to-host bandwidth (default unlimited)')
+    p.add_argument('--latency', type=float, default=0, metavar='SECS', help='Overhead of each adb command (default none)')
+    p.add_argument('--gzip-rate', type=float, default=0, metavar='MB/s', help="Speed of the device's gzip (default unlimited)")
+    p.add_argument('--repeat', type=int, default=5, help='Number of build_partmap calls to time (default %(default)s)')
+    p.add_argument('--only', action='append', metavar='PREFIX', help='Only run benchmarks whose names start with PREFIX')
+    p.add_argument('--json', metavar='FILE', help='Save results to FILE')
+    p.add_argument('--compare', metavar='FILE', help='Compare wall times with results saved by an earlier run')
+    p.add_argument('-v', '--verbose', action='store_true', help="Show tetherback's output")
+    p.add_argument('--dir', default=None, help='Where to create the fake device and backups (default: a temporary directory)')
+    args = p.parse_args(args)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as d:
+        devices, bindir, outdir = (os.path.join(d, x) for x in ('devices', 'bin', 'out'))
+        make_device(devices, scale=args.scale << 20)
+        os.mkdir(bindir)
+        os.mkdir(outdir)
+        # main() runs whichever adb is first in $PATH
+        os.symlink(FAKEADB, os.path.join(bindir, 'adb'))
+        os.environ.update(PATH=bindir + os.pathsep + os.environ['PATH'], FAKEADB_DEVICES=devices,
+                          XDG_CACHE_HOME=os.path.join(d, 'cache'), FAKEADB_BANDWIDTH=str(args.bandwidth),
+                          FAKEADB_LATENCY=str(args.latency), FAKEADB_GZIP_RATE=str(args.gzip_rate))
+
+        adb = AdbWrapper(FAKEADB)
+        with quiet():
+            partmap = tb.build_partmap(adb)
+
+        benchmarks = [
+            ('build_partmap x%d' % args.repeat, bench_partmap(adb, False, args.repeat), 0),
+            ('build_partmap x%d (session)' % args.repeat, bench_partmap(adb, True, args.repeat), 0),
+        ]
+        for transport in tb.adbxp:
+            benchmarks.append(('transport: %s' % transport.name, bench_transport(adb, partmap, transport, outdir), partmap['boot'].size*512))
+        benchmarks.append(('transport: pipe_xo -Z', bench_transport(adb, partmap, tb.adbxp.pipe_xo, outdir, True), partmap['boot'].size*512))
+        for name, argv in MAIN_RUNS:
+            with quiet():
+                _, targs = tb.parse_args(argv)
+            nbytes = sum(partmap[standard].size*512 for standard in tb.plan_backup(targs))
+            benchmarks.append((name, bench_main(argv, outdir), nbytes))
+
+        results = []
+        for name, fn, nbytes in benchmarks:
+            if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                continue
+            print('Running %s...' % name, file=sys.stderr)
+            wall, cpu = measure(fn, args.verbose)
+            results.append(dict(name=name, wall=wall, cpu=cpu, bytes=nbytes, rate=nbytes and nbytes/wall/1e6))
+            shutil.rmtree(outdir)
+            os.mkdir(outdir)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {r['name']: r for r in json.load(f)['results']}
+
+    headers = ['benchmark', 'wall (s)', 'host CPU (s)', 'MB/s'] + (['wall vs. previous'] if previous else [])
+    table = []
+    for r in results:
+        row = [r['name'], '%.2f' % r['wall'], '%.3f' % r['cpu'], '%.1f' % r['rate'] if r['rate'] else '']
+        if previous:
+            old = previous.get(r['name'])
+            row.append('%+.0f%%' % (100*(r['wall']/old['wall'] - 1)) if old else '')
+        table.append(row)
+    print(tabulate(table, headers))
+
+    if args.json:
+        settings = {k: getattr(args, k) for k in ('scale', 'bandwidth', 'latency', 'gzip_rate', 'repeat')}
+        with open(args.json, 'w') as f:
+            json.dump(dict(settings=settings, results=results), f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark of the host side of backup_partition's data path: host CPU
+# time (all threads of this process, not the producer) per GB for the old loop (64 KiB read() per block, inline md5, progress
+# bar update per block) versus the readinto/threaded-md5/throttled-progress
+# loop and the splice() path.
+#
+#   python3 benchmarks/bench_xfer.py [--size MiB] [--no-verify] [--dir DIR]
+
+import os, sys, time, argparse, resource, tempfile, subprocess as sp
+from hashlib import md5
+from progressbar import ProgressBar, Percentage, ETA, FileTransferSpeed, DataSize
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tetherback.xfer import Source, AsyncHasher, TailHasher, Throttle, splice_to_file, can_splice
+
+def producer(size):
+    # stands in for 'adb exec-out': another process writing into a pipe
+    return sp.Popen(('head', '-c', str(size), '/dev/zero'), stdout=sp.PIPE)
+
+def progressbar(size):
+    widgets = ['  bench: ', Percentage(), ' ', ETA(), ' ', FileTransferSpeed(), ' ', DataSize() ]
+    return ProgressBar(max_value=size, widgets=widgets, fd=open(os.devnull, 'w')).start()
+
+def old_loop(size, outfn, verify=True):
+    child = producer(size)
+    pbar = progressbar(size)
+    h = md5()
+    with open(outfn, 'wb') as out:
+        for block in iter(lambda: child.stdout.read(65536), b''):
+            out.write(block)
+            if verify:
+                h.update(block)
+            pbar.update(out.tell())
+    child.wait()
+    return h.hexdigest()
+
+def new_loop(size, outfn, verify=True):
+    child = producer(size)
+    pbar = progressbar(size)
+    progress = Throttle(pbar.update)
+    hasher = verify and AsyncHasher(md5())
+    source = Source(child.stdout.raw.readinto, child.stdout.fileno())
+    nbytes = 0
+    with open(outfn, 'wb') as out:
+        for block in source.blocks(hasher):
+            out.write(block)
+            nbytes += len(block)
+            progress(nbytes)
+    progress.flush()
+    child.wait()
+    return hasher and hasher.hexdigest()
+
+def splice_loop(size, outfn, verify=True):
+    child = producer(size)
+    pbar = progressbar(size)
+    source = Source(child.stdout.raw.readinto, child.stdout.fileno())
+    with open(outfn, 'wb') as out:
+        hasher = verify and TailHasher(md5(), outfn)
+        splice_to_file(source, out.fileno(), Throttle(pbar.update), hasher)
+    child.wait()
+    return hasher and hasher.hexdigest()
+
+def measure(fn, size, outfn, verify=True):
+    r0, t0 = resource.getrusage(resource.RUSAGE_SELF), time.monotonic()
+    digest = fn(size, outfn, verify)
+    r1, t1 = resource.getrusage(resource.RUSAGE_SELF), time.monotonic()
+    cpu = (r1.ru_utime - r0.ru_utime) + (r1.ru_stime - r0.ru_stime)
+    return digest, t1 - t0, cpu
+
+def main(args=None):
+    p = argparse.ArgumentParser(description='Host CPU per GB for the backup_partition data path')
+    p.add_argument('--size', type=int, default=1024, metavar='MiB', help='Amount of data per run (default %(default)s MiB)')
+    p.add_argument('-V', '--no-verify', dest='verify', default=True, action='store_false', help="Leave out the md5, to show the overhead of the loop itself")
+    p.add_argument('--dir', default=None, help='Where to write the output file (default: a temporary directory)')
+    args = p.parse_args(args)
+
+    size = args.size << 20
+    loops = [('old: read()+md5+pbar per block', old_loop), ('new: readinto+md5 thread+throttle', new_loop)]
+    if can_splice:
+        loops.append(('new: splice+page-cache md5', splice_loop))
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as d:
+        outfn = os.path.join(d, 'bench.out')
+        print('%-36s %10s %10s %12s' % ('data path', 'wall (s)', 'MB/s', 'CPU s/GB'))
+        for name, fn in loops:
+            digest, wall, cpu = measure(fn, size, outfn, args.verify)
+            if os.path.getsize(outfn) != size:
+                raise RuntimeError('%s: wrote %d bytes, expected %d' % (name, os.path.getsize(outfn), size))
+            print('%-36s %10.2f %10.1f %12.3f' % (name, wall, size / wall / 1e6, cpu / (size / 1e9)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+#
+# Stand-in for the adb executable, for benchmarking and testing tetherback without
+# a phone: AdbWrapper(adbbin='benchmarks/fakeadb.py'), or an 'adb' symlink to this
+# script early in $PATH. Supports version, devices, get-serialno, get-state,
+# forward, shell (with or without a command), exec-out and exec-in.
+#
+# Each fake device is a directory under $FAKEADB_DEVICES, named by its serial
+# number (see fakedevice.py, which creates them):
+#
+#   sys/block/mmcblk0/...      uevent and size files, as on the device
+#   proc/partitions, etc/fstab
+#   dev/block/mmcblk0pN        partition images
+#   fs/<mountpoint>/           contents of each filesystem, for tar
+#   mounts                     current mount table, as printed by 'mount'
+#   tmp/                       for FIFOs and such
+#   fakeadb.json               optional settings (see SETTINGS)
+#   offline                    if present, new adb commands fail as for a device
+#                              which has dropped off USB (touch and rm it mid-run)
+#
+# Device-side commands run in the host's sh, with paths under /dev/block, /sys,
+# /proc/partitions, /etc and /tmp redirected into the device directory, and
+# mount, umount, tar, gzip, dd, nc, stty and twrp replaced by shell functions which
+# emulate TWRP's versions. Settings can be overridden by FAKEADB_<NAME>
+# environment variables.
+
+import os, sys, re, json, time, fcntl, signal, socket, random, subprocess as sp, threading
+
+SETTINGS = dict(
+    version='1.0.39',   # adb version reported
+    bandwidth=0.0,      # MB/s from device to host (USB link), 0 for unlimited
+    latency=0.0,        # seconds of overhead for each adb command (process spawn, USB round-trip)
+    gzip_rate=0.0,      # MB/s of input that the device's gzip can compress, 0 for unlimited
+    corrupt=0.0,        # chance of flipping a bit in each 64 KiB sent by exec-out or nc (for testing verification)
+    state='recovery',   # reported by 'adb devices' and 'adb get-state'
+    usb='1-1',          # USB bus and port path, reported by 'adb devices -l'
+    shell_v2=False,     # whether 'adb shell' passes on the exit status (TWRP's adbd usually doesn't)
+    kernel='3.10.73-fake',
+    twrp='3.0.2-0',
+)
+
+SELF = os.path.abspath(__file__)
+
+def die(msg, status=1):
+    print('error: ' + msg, file=sys.stderr)
+    sys.exit(status)
+
+def devices_root():
+    root = os.environ.get('FAKEADB_DEVICES')
+    if not root or not os.path.isdir(root):
+        die('FAKEADB_DEVICES must name a directory of fake devices')
+    return os.path.abspath(root)
+
+def settings(devdir):
+    s = dict(SETTINGS)
+    try:
+        with open(os.path.join(devdir, 'fakeadb.json')) as f:
+            s.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    for k, v in SETTINGS.items():
+        if 'FAKEADB_' + k.upper() in os.environ:
+            v, e = type(v), os.environ['FAKEADB_' + k.upper()]
+            s[k] = e.lower() in ('1', 'true', 'yes') if v is bool else v(e)
+    return s
+
+def copy_throttled(src, dst, rate, bufsize=65536, corrupt=0.0):
+    # copy between file descriptors at no more than rate MB/s (0 for unlimited),
+    # flipping a random bit of a block with probability corrupt
+    t0, total = time.monotonic(), 0
+    while True:
+        data = os.read(src, bufsize)
+        if not data:
+            break
+        if corrupt and random.random() < corrupt:
+            data = bytearray(data)
+            data[random.randrange(len(data))] ^= 1 << random.randrange(8)
+        write_all(dst, data)
+        total += len(data)
+        if rate:
+            delay = t0 + total / (rate * 1e6) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    return total
+
+########################################
+# Device-side shell
+
+PRELUDE = r'''
+R=%(root)s
+fakeadb() { "%(python)s" "%(self)s" "$@"; }
+twrp() {
+  case $1 in
+    wipe) d=$R/fs/${2#/}; [ -d "$d" ] && find "$d" -mindepth 1 -maxdepth 1 ! -path $R/fs/data/media -exec rm -rf {} +;;
+    *) echo "TWRP version %(twrp)s";;
+  esac
+}
+uname() { [ "$1" = -r ] && echo "%(kernel)s" || command uname "$@"; }
+stty() { :; }
+mount() {
+  if [ $# = 0 ]; then cat $R/mounts; return; fi
+  [ "$1" = -o ] && shift 2
+  set -- $(awk -v a="${1#$R}" '$1==a || $2==a {print $1, $2, $3; exit}' $R/etc/fstab)
+  [ $# = 3 ] || { echo "mount: unknown device or mount point" >&2; return 1; }
+  grep -q "^$1 " $R/mounts || echo "$1 on $2 type $3 (rw,relatime)" >> $R/mounts
+}
+umount() {
+  while [ "${1#-}" != "$1" ]; do shift; done
+  d=${1#$R}
+  grep -q -e "^$d " -e " on $d " $R/mounts || { echo "umount: can't unmount $d: Invalid argument" >&2; return 1; }
+  grep -v -e "^$d " -e " on $d " $R/mounts > $R/mounts.new; mv $R/mounts.new $R/mounts
+}
+gzip() {
+  case " $* " in
+    *" -d "*|*" -dc "*|*" -cd "*) command gzip "$@";;
+    *) if [ %(gzip_rate)s != 0 ]; then fakeadb _throttle %(gzip_rate)s | command gzip "$@"; else command gzip "$@"; fi;;
+  esac
+}
+tar() {
+  # tetherback's form: tar -{c,x}[z]C MOUNTPOINT ...; unmounted filesystems look empty
+  a=$1; d=$2
+  case $a in -*C) shift 2;; *) command tar "$@"; return;; esac
+  if grep -q " on $d " $R/mounts; then d=$R/fs$d; else mkdir -p $R/unmounted; d=$R/unmounted; fi
+  case $a in
+    *z*x*|*x*z*) command gzip -dc | command tar $(echo $a | tr -d z) "$d" "$@";;
+    *z*) command tar $(echo $a | tr -d z) "$d" "$@" | gzip -f;;
+    *) command tar $a "$d" "$@";;
+  esac
+}
+nc() { fakeadb _nc "$@"; }
+# partition images are regular files, which dd of= would truncate
+dd() { case " $* " in *" of="*) command dd conv=notrunc "$@";; *) command dd "$@";; esac; }
+'''
+
+PATHS = re.compile(r'(?<![\w/.])(/dev/block\b|/sys/|/proc/partitions\b|/etc/|/tmp/)')
+
+def device_cmd(devdir, cmd):
+    return PATHS.sub(lambda m: devdir + m.group(1), cmd)
+
+def prelude(devdir, s):
+    return PRELUDE % dict(s, root=devdir, python=sys.executable, self=SELF, gzip_rate='%g' % s['gzip_rate'])
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def strip_root(src, dst, devdir, rate):
+    # copy device output to the host, hiding the device directory in any paths
+    root, carry = devdir.encode(), b''
+    t0, total = time.monotonic(), 0
+    while True:
+        data = os.read(src, 65536)
+        if not data:
+            break
+        data = (carry + data).replace(root, b'')
+        # hold back a possible partial match at the end
+        keep = next((n for n in range(min(len(root)-1, len(data)), 0, -1) if root.startswith(data[-n:])), 0)
+        data, carry = (data[:-keep], data[-keep:]) if keep else (data, b'')
+        write_all(dst, data)
+        total += len(data)
+        if rate:
+            delay = t0 + total / (rate * 1e6) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    write_all(dst, carry)
+
+def run_command(devdir, s, cmd, binary):
+    child = sp.Popen(['sh', '-c', prelude(devdir, s) + device_cmd(devdir, cmd)], cwd=devdir,
+                     stdout=sp.PIPE, start_new_session=True)
+    # adb kills the device-side command when the host side goes away
+    signal.signal(signal.SIGTERM, lambda *a: (os.killpg(child.pid, signal.SIGKILL), os._exit(1)))
+    try:
+        if binary:
+            copy_throttled(child.stdout.fileno(), sys.stdout.fileno(), s['bandwidth'], corrupt=s['corrupt'])
+        else:
+            strip_root(child.stdout.fileno(), sys.stdout.fileno(), devdir, s['bandwidth'])
+    except BrokenPipeError:
+        os.killpg(child.pid, signal.SIGKILL)
+    return child.wait()
+
+def interactive_shell(devdir, s):
+    # 'adb shell' without a command: commands arrive one per line on stdin
+    child = sp.Popen(['sh', '-s'], cwd=devdir, stdin=sp.PIPE, stdout=sp.PIPE)
+    t = threading.Thread(target=strip_root, args=(child.stdout.fileno(), sys.stdout.fileno(), devdir, 0), daemon=True)
+    t.start()
+    child.stdin.write(prelude(devdir, s).encode())
+    child.stdin.flush()
+    for l in sys.stdin.buffer:
+        time.sleep(s['latency'])
+        child.stdin.write(device_cmd(devdir, l.decode()).encode())
+        child.stdin.flush()
+    child.stdin.close()
+    status = child.wait()
+    t.join()
+    return status
+
+########################################
+# Helpers which run "on the device"
+
+def throttle_main(args):
+    copy_throttled(0, 1, float(args[0]))
+
+def nc_main(args):
+    # nc -l -p PORT [-w SECS]: serve stdin to one client, at the USB link's speed.
+    # Without -w, also copy what the client sends to stdout, until it shuts down its side.
+    port = int(re.search(r'-p\s*(\d+)', ' '.join(args)).group(1))
+    l = socket.socket()
+    l.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    l.bind(('127.0.0.1', port))
+    l.listen(1)
+    c, addr = l.accept()
+    l.close()
+    rate, corrupt = float(os.environ.get('FAKEADB_BANDWIDTH', 0)), float(os.environ.get('FAKEADB_CORRUPT', 0))
+    if '-w' in ' '.join(args):
+        copy_throttled(0, c.fileno(), rate, corrupt=corrupt)
+    else:
+        t = threading.Thread(target=copy_throttled, args=(c.fileno(), 1, rate))
+        t.start()
+        copy_throttled(0, c.fileno(), rate, corrupt=corrupt)
+        c.shutdown(socket.SHUT_WR)
+        t.join()
+    c.close()
+
+########################################
+
+def select_device(root, devsel):
+    serials = sorted(os.listdir(root))
+    serial = devsel or os.environ.get('ANDROID_SERIAL')
+    if serial:
+        if serial not in serials:
+            die("device '%s' not found" % serial)
+        return serial
+    elif not serials:
+        die('no devices/emulators found')
+    elif len(serials) > 1:
+        die('more than one device/emulator')
+    return serials[0]
+
+def main(argv):
+    root = devices_root()
+    serial = None
+    while argv and argv[0] in ('-s', '-d', '-e', '-H', '-P', '-t'):
+        if argv[0] == '-s':
+            serial = argv[1]
+        argv = argv[2:] if argv[0] in ('-s', '-H', '-P', '-t') else argv[1:]
+    cmd, args = (argv[0], argv[1:]) if argv else ('version', [])
+
+    if cmd in ('_throttle', '_nc'):
+        return {'_throttle': throttle_main, '_nc': nc_main}[cmd](args)
+    elif cmd == 'version':
+        print('Android Debug Bridge version %s' % settings(root)['version'])
+        return
+    elif cmd == 'devices':
+        print('List of devices attached')
+        for serial in sorted(os.listdir(root)):
+            s = settings(os.path.join(root, serial))
+            if args[:1] == ['-l']:
+                print('%-22s %s usb:%s product:fake model:Fake_Phone device:fake' % (serial, s['state'], s['usb']))
+            else:
+                print('%s\t%s' % (serial, s['state']))
+        print()
+        return
+
+    serial = select_device(root, serial)
+    devdir = os.path.join(root, serial)
+    if os.path.exists(os.path.join(devdir, 'offline')):
+        die("device '%s' offline" % serial)
+    s = settings(devdir)
+    os.environ['FAKEADB_BANDWIDTH'] = str(s['bandwidth'])
+    os.environ['FAKEADB_CORRUPT'] = str(s['corrupt'])
+    time.sleep(s['latency'])
+
+    if cmd == 'get-serialno':
+        print(serial)
+    elif cmd == 'get-state':
+        print(s['state'])
+    elif cmd == 'forward':
+        # the fake device's nc listens on the host, so only same-port forwards make sense
+        fwd = open(os.path.join(devdir, 'forwards'), 'a+')
+        fcntl.lockf(fwd, fcntl.LOCK_EX)
+        fwd.seek(0)
+        forwards = fwd.read().split()
+        if args[:1] == ['--list']:
+            for f in forwards:
+                print('%s %s %s' % (serial, f, f))
+            return
+        elif args[:1] == ['--remove']:
+            if args[1] not in forwards:
+                die("listener '%s' not found" % args[1])
+            forwards.remove(args[1])
+        elif args[:1] == ['--remove-all']:
+            forwards = []
+        elif args[:1] == ['--no-rebind'] and len(args) == 3 and args[1] == args[2] and args[1].startswith('tcp:'):
+            # host ports are shared between all devices
+            taken = list(forwards)
+            for other in os.listdir(root):
+                if other != serial and os.path.exists(os.path.join(root, other, 'forwards')):
+                    with open(os.path.join(root, other, 'forwards')) as f:
+                        taken += f.read().split()
+            if args[1] in taken:
+                die('cannot rebind existing socket')
+            forwards.append(args[1])
+        elif len(args) == 2 and args[0] == args[1] and args[0].startswith('tcp:'):
+            forwards += [args[0]] if args[0] not in forwards else []
+        else:
+            die('fakeadb only supports forwarding tcp:PORT to the same tcp:PORT')
+        fwd.seek(0)
+        fwd.truncate()
+        print(' '.join(forwards), file=fwd)
+        fwd.close()
+    elif cmd == 'shell' and not args:
+        return interactive_shell(devdir, s)
+    elif cmd in ('shell', 'exec-out', 'exec-in'):
+        # the device-side command inherits stdin, for exec-in
+        status = run_command(devdir, s, ' '.join(args), binary=(cmd != 'shell'))
+        return status if s['shell_v2'] else 0
+    else:
+        die('fakeadb does not support: %s' % cmd)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
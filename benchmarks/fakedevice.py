@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+#
+# Creates a fake device directory for fakeadb.py:
+#
+#   python3 benchmarks/fakedevice.py DEVICES [--serial S] [--scale MiB] [--bandwidth MB/s] ...
+#
+# Partition images and filesystem contents are half random and half zeros, so
+# that they compress about as well as real ones. With --ext4, the ext4 partitions
+# contain real filesystems (made with mke2fs -d from their contents) over the
+# random data, so that --sparse has allocation bitmaps to read.
+
+import os, json, shutil, argparse, subprocess as sp
+
+# (partname, size in units of scale, mountpoint, fstype); None for raw partitions
+LAYOUT = (
+    ('boot', 1, None, None),
+    ('recovery', 1, None, None),
+    ('cache', 2, '/cache', 'ext4'),
+    ('system', 8, '/system', 'ext4'),
+    ('userdata', 16, '/data', 'ext4'),
+)
+
+def fill(path, size):
+    # half pseudo-random, half zeros
+    half = size // 2
+    with open(path, 'wb') as f:
+        while half > 0:
+            block = os.urandom(min(half, 1<<20))
+            f.write(block)
+            half -= len(block)
+        f.truncate(size)
+
+def make_device(root, serial='FAKE0001', scale=4<<20, layout=LAYOUT, ext4=False, **settings):
+    # Returns the device directory. Filesystems are populated with about a third
+    # of their partition size, including /data/media and an app cache, which
+    # tetherback excludes by default.
+    devdir = os.path.join(root, serial)
+    shutil.rmtree(devdir, ignore_errors=True)
+    sysblock = os.path.join(devdir, 'sys', 'block', 'mmcblk0')
+    for d in ('sys/block/mmcblk0', 'dev/block', 'etc', 'proc', 'tmp', 'fs'):
+        os.makedirs(os.path.join(devdir, d), exist_ok=True)
+
+    with open(os.path.join(sysblock, 'uevent'), 'w') as f:
+        print('MAJOR=179\nMINOR=0\nDEVNAME=mmcblk0\nDEVTYPE=disk\nNPARTS=%d' % len(layout), file=f)
+    fstab = open(os.path.join(devdir, 'etc', 'fstab'), 'w')
+    partitions = open(os.path.join(devdir, 'proc', 'partitions'), 'w')
+    print('major minor  #blocks  name\n', file=partitions)
+
+    for partn, (partname, size, mountpoint, fstype) in enumerate(layout, 1):
+        devname = 'mmcblk0p%d' % partn
+        size *= scale
+        os.makedirs(os.path.join(sysblock, devname))
+        with open(os.path.join(sysblock, devname, 'uevent'), 'w') as f:
+            print('MAJOR=179\nMINOR=%d\nDEVNAME=%s\nDEVTYPE=partition\nPARTN=%d\nPARTNAME=%s' % (partn, devname, partn, partname), file=f)
+        with open(os.path.join(sysblock, devname, 'size'), 'w') as f:
+            print(size // 512, file=f)
+        print(' 179 %5d %8d %s' % (partn, size // 1024, devname), file=partitions)
+        fill(os.path.join(devdir, 'dev', 'block', devname), size)
+
+        if mountpoint:
+            print('/dev/block/%s %s %s rw 0 0' % (devname, mountpoint, fstype), file=fstab)
+            fsdir = os.path.join(devdir, 'fs', mountpoint.lstrip('/'))
+            dirs = ('app', 'media/0', 'data/com.example-cache') if mountpoint == '/data' else ('app', 'lib')
+            for d in dirs:
+                os.makedirs(os.path.join(fsdir, d))
+                fill(os.path.join(fsdir, d, 'blob'), size // 3 // len(dirs))
+                with open(os.path.join(fsdir, d, 'small.txt'), 'w') as f:
+                    print('hello from %s' % d, file=f)
+            if ext4 and fstype == 'ext4':
+                sp.check_call(('mke2fs', '-q', '-F', '-t', 'ext4', '-E', 'nodiscard', '-d', fsdir,
+                               os.path.join(devdir, 'dev', 'block', devname)))
+
+    fstab.close()
+    partitions.close()
+    open(os.path.join(devdir, 'mounts'), 'w').close()
+    if settings:
+        with open(os.path.join(devdir, 'fakeadb.json'), 'w') as f:
+            json.dump(settings, f, indent=2)
+    return devdir
+
+def main(args=None):
+    p = argparse.ArgumentParser(description='Create a fake device for fakeadb.py')
+    p.add_argument('devices', help='Directory of fake devices (use as $FAKEADB_DEVICES)')
+    p.add_argument('--serial', default='FAKE0001')
+    p.add_argument('--scale', type=int, default=4, metavar='MiB', help='Size of the boot partition; others are multiples of it (default %(default)s MiB)')
+    p.add_argument('--bandwidth', type=float, metavar='MB/s', help='Device-to-host bandwidth')
+    p.add_argument('--latency', type=float, metavar='SECS', help='Overhead of each adb command')
+    p.add_argument('--gzip-rate', type=float, metavar='MB/s', help="Speed of the device's gzip")
+    p.add_argument('--usb', metavar='BUS-PORT', help="USB bus and port path, e.g. 1-1.2")
+    p.add_argument('--state', help="State reported by adb devices (default recovery)")
+    p.add_argument('--ext4', action='store_true', help="Make real ext4 filesystems on the ext4 partitions (needs mke2fs with -d)")
+    args = p.parse_args(args)
+
+    settings = {k: getattr(args, k) for k in ('bandwidth', 'latency', 'gzip_rate', 'usb', 'state') if getattr(args, k) is not None}
+    print(make_device(args.devices, args.serial, args.scale << 20, ext4=args.ext4, **settings))
+
+if __name__ == '__main__':
+    main()
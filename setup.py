@@ -36,7 +36,7 @@ setup(name="tetherback",
       long_description=open('README.md').read(),
       author="Daniel Lenski",
       author_email="dlenski@gmail.com",
-      install_requires=[ 'progressbar2>=3.6', 'tabulate' ],
+      install_requires=[ 'progressbar2>=4.0', 'tabulate' ],
       license='GPL v3 or later',
       url="https://github.com/dlenski/tetherback",
       packages=["tetherback"],
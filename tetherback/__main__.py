@@ -1,3 +1,28 @@
-from .tetherback import main
+import sys
+from .tetherback import main as backup_main
+from .store import reassemble_main
+from .fleet import fleet_main
+from .restore import restore_main
+from .sparse import unsparse_main
+from .tarindex import ls_main, extract_main
+from .verify import verify_main
 
-main()
+# subcommands; anything else is an argument list for a backup
+commands = {
+    'reassemble': reassemble_main,
+    'fleet': fleet_main,
+    'restore': restore_main,
+    'unsparse': unsparse_main,
+    'ls': ls_main,
+    'extract': extract_main,
+    'verify': verify_main,
+}
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    if args and args[0] in commands:
+        return commands[args[0]](args[1:])
+    return backup_main(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
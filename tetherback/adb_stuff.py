@@ -1,8 +1,11 @@
+import time, socket
+import subprocess as sp
+from sys import stderr
 from . import adb_wrapper
 
 def really_mount(adb, dev, node, mode='ro'):
     for opts in (mode, 'remount,'+mode):
-        if adb.check_output(('shell','mount -o %s %s %s 2>/dev/null && echo ok' % (opts, dev, node))).strip():
+        if adb.check_output(('shell','mount -o %s %s %s 2>/dev/null && echo ok || true' % (opts, dev, node))).strip():
             break
     for l in adb.check_output(('shell','mount')).splitlines():
         f = l.split()
@@ -17,9 +20,9 @@ def really_mount(adb, dev, node, mode='ro'):
 
 def really_umount(adb, dev, node):
     for opts in ('','-f','-l','-r'):
-        if adb.check_output(('shell','umount %s 2>/dev/null && echo ok' % dev)).strip():
+        if adb.check_output(('shell','umount %s 2>/dev/null && echo ok || true' % dev)).strip():
             break
-        if adb.check_output(('shell','umount %s 2>/dev/null && echo ok' % node)).strip():
+        if adb.check_output(('shell','umount %s 2>/dev/null && echo ok || true' % node)).strip():
             break
     for l in adb.check_output(('shell','mount')).splitlines():
         f = l.split()
@@ -34,19 +37,63 @@ def really_umount(adb, dev, node):
     return True
 
 def really_forward(adb, port1, port2):
+    # --no-rebind: a port already forwarded (perhaps for another device, in fleet mode)
+    # mustn't be taken over, or its connections would get our stream; try the next one
     for port in range(port1, port2):
-        if adb.call(('forward','tcp:%d'%port,'tcp:%d'%port))==0:
+        if adb.call(('forward','--no-rebind','tcp:%d'%port,'tcp:%d'%port), stderr=sp.DEVNULL)==0:
             return port
         time.sleep(1)
 
+# sent by the device ahead of the data, once nc is listening
+TCP_READY = b'tetherback-ready\n'
+
+def tcp_cmdline(cmdline, port):
+    return '(echo %s; %s) | nc -l -p%d -w3' % (TCP_READY.decode().strip(), cmdline, port)
+
+def tcp_in_cmdline(cmdline, port):
+    # the other way round: the device sends the preamble, and cmdline reads what the host sends
+    return 'echo %s | nc -l -p%d | %s' % (TCP_READY.decode().strip(), port, cmdline)
+
+def connect_ready(port, child, timeout=30):
+    # Until nc is listening on the device, adb accepts connections to the forwarded
+    # port but closes them straight away; so keep trying until the preamble arrives.
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
+        got, s = b'', None
+        try:
+            # a stalled forward mustn't keep us waiting past the deadline
+            s = socket.create_connection(('localhost', port), timeout=max(deadline - time.monotonic(), 0.1))
+            while len(got) < len(TCP_READY):
+                block = s.recv(len(TCP_READY) - len(got))
+                if not block:
+                    break
+                got += block
+        except (ConnectionError, socket.timeout):
+            # refused, or reset as adb tears down an early connection
+            pass
+        if got == TCP_READY:
+            s.settimeout(None)
+            return s
+        elif s:
+            s.close()
+
+        if got and not TCP_READY.startswith(got):
+            raise RuntimeError('unexpected data from device on TCP port %d: %r' % (port, got))
+        elif child.poll() is not None:
+            raise RuntimeError('device-side nc on TCP port %d exited before accepting a connection' % port)
+        elif time.monotonic() > deadline:
+            raise RuntimeError('timed out waiting for device-side nc on TCP port %d' % port)
+        time.sleep(delay)
+        delay = min(delay*2, 1)
+
 def really_unforward(adb, port, tries=3):
     for retry in range(tries):
         if adb.call(('forward','--remove','tcp:%d'%port))==0:
             return retry+1
         time.sleep(1)
 
-def uevent_dict(adb, path):
-    lines = adb.check_output(('shell','cat "%s"'%path)).splitlines()
+def parse_uevent(lines, path):
     d = {}
     for l in lines:
         if not l:
@@ -58,8 +105,7 @@ def uevent_dict(adb, path):
             d[k] = v
     return d
 
-def fstab_dict(adb, path='/etc/fstab'):
-    lines = adb.check_output(('shell','cat '+path)).splitlines()
+def parse_fstab(lines, path):
     d = {}
     for l in lines:
         if not l:
@@ -72,3 +118,21 @@ def fstab_dict(adb, path='/etc/fstab'):
                 # devname -> (mountpoint, fstype)
                 d[f[0]] = (f[1], f[2])
     return d
+
+def cat_files(adb, *globs):
+    # cat many device files (shell globs allowed) with a single adb round-trip,
+    # and split the output into path -> [lines]
+    cmd = 'for f in %s; do if [ -f "$f" ]; then echo "==> $f <=="; cat "$f"; fi; done' % ' '.join(globs)
+    d, lines = {}, None
+    for l in adb.check_output(('shell',cmd)).splitlines():
+        l = l.rstrip('\r')
+        if l.startswith('==> ') and l.endswith(' <=='):
+            lines = d[l[4:-4]] = []
+        elif lines is not None:
+            lines.append(l)
+    return d
+
+def device_fingerprint(adb, *paths):
+    # cheap, single round-trip digest of small device files (e.g. /proc/partitions)
+    output = adb.check_output(('shell','cat %s 2>/dev/null | md5sum' % ' '.join(paths))).split()
+    return output[0] if output else None
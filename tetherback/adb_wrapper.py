@@ -1,10 +1,94 @@
 import subprocess as sp
-import re
+import re, sys, threading, uuid, asyncio
+from contextlib import contextmanager
+
+class AdbShellSession(object):
+    '''One long-lived adb shell; each command's output is framed by a unique
+    sentinel line carrying its exit status.'''
+
+    def __init__(self, adbcmd):
+        self.child = sp.Popen(adbcmd, stdin=sp.PIPE, stdout=sp.PIPE)
+        self.lock = threading.Lock()
+        self.tag = '__tetherback_%s_' % uuid.uuid4().hex
+        self.seq = 0
+
+        # If adb gave us a pty, turn off echo and CR/LF mangling, and silence the prompt.
+        ready = (self.tag + 'ready').encode()
+        self._send('stty -echo -onlcr 2>/dev/null; PS1=""; PS2=""; echo %s\n' % ready.decode())
+        while True:
+            l = self.child.stdout.readline()
+            if not l:
+                self.close()
+                raise EOFError("adb shell session exited during startup")
+            elif l.rstrip(b'\r\n') == ready:
+                break
+
+    def _send(self, s):
+        self.child.stdin.write(s.encode())
+        self.child.stdin.flush()
+
+    def run(self, cmd):
+        with self.lock:
+            self.seq += 1
+            sentinel = ('%s%d ' % (self.tag, self.seq)).encode()
+            # subshell so that exit/cd/etc. can't disturb the session, and the
+            # leading newline ensures that the sentinel starts its own line
+            self._send('(%s) </dev/null; printf "\\n%s%%d\\n" $?\n' % (cmd, sentinel.decode()))
+            out = []
+            while True:
+                l = self.child.stdout.readline()
+                if not l:
+                    self.close()
+                    raise EOFError("adb shell session exited unexpectedly")
+                elif l.startswith(sentinel):
+                    status = int(l[len(sentinel):])
+                    break
+                out.append(l)
+            # strip the newline that we inserted before the sentinel
+            out = b''.join(out)
+            out = out[:-2] if out.endswith(b'\r\n') else out[:-1]
+            return status, out
+
+    def close(self):
+        if self.child.poll() is None:
+            try:
+                self.child.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.child.wait(timeout=3)
+            except sp.TimeoutExpired:
+                self.child.kill()
+                self.child.wait()
 
 class AdbWrapper(object):
     def __init__(self, adbbin='adb', devsel=()):
         self.adbbin = adbbin
         self.devsel = tuple(devsel)
+        self.session = None
+        self.tracer = None
+
+    def start_session(self):
+        self.close_session()
+        self.session = AdbShellSession(self.adbcmd(('shell',)))
+
+    def close_session(self):
+        if self.session:
+            self.session.close()
+            self.session = None
+
+    def _via_session(self, adbargs, kwargs):
+        # Only plain 'adb shell' commands, without redirections or other Popen options,
+        # can be run through the session with identical semantics.
+        return (self.session is not None and len(adbargs)>1 and adbargs[0]=='shell'
+                and not (set(kwargs) - {'universal_newlines'}))
+
+    def _session_run(self, adbargs):
+        try:
+            return self.session.run(' '.join(adbargs[1:]))
+        except (EOFError, OSError):
+            self.session = None
+            return None
 
     def get_version(self):
          try:
@@ -22,18 +106,119 @@ class AdbWrapper(object):
          adbversion = tuple(int(x) for x in adbversions.split('.'))
          return adbversions, adbversion
 
+    def get_serialno(self):
+        try:
+            serial = self.check_output(('get-serialno',), stderr=sp.DEVNULL).strip()
+        except (OSError, sp.CalledProcessError):
+            return None
+        return serial if serial and serial!='unknown' else None
+
     def adbcmd(self, adbargs):
         return (self.adbbin,) + self.devsel + tuple(adbargs)
 
+    @contextmanager
+    def _traced(self, adbargs, kwargs):
+        # time this invocation, if there's a Tracer
+        if self.tracer:
+            with self.tracer.adb(adbargs, self._via_session(adbargs, kwargs)) as ev:
+                yield ev
+        else:
+            yield {}
+
     def check_output(self, adbargs, **kwargs):
+        with self._traced(adbargs, kwargs):
+            return self._check_output(adbargs, **kwargs)
+
+    def _check_output(self, adbargs, **kwargs):
         un = kwargs.pop('universal_newlines', True)
+        if self._via_session(adbargs, kwargs):
+            r = self._session_run(adbargs)
+            if r is not None:
+                status, output = r
+                if un:
+                    output = output.decode().replace('\r\n','\n')
+                if status:
+                    raise sp.CalledProcessError(status, self.adbcmd(adbargs), output)
+                return output
         return sp.check_output(self.adbcmd(adbargs), universal_newlines=un, **kwargs)
 
     def pipe_out(self, adbargs, **kwargs):
-        return sp.Popen(self.adbcmd(adbargs), stdout=sp.PIPE, **kwargs)
+        # only the time to start it; backup phases account for the stream itself
+        with self._traced(adbargs, kwargs) as ev:
+            ev['stream'] = True
+            return sp.Popen(self.adbcmd(adbargs), stdout=sp.PIPE, **kwargs)
+
+    def pipe_in(self, adbargs, **kwargs):
+        with self._traced(adbargs, kwargs) as ev:
+            ev['stream'] = True
+            return sp.Popen(self.adbcmd(adbargs), stdin=sp.PIPE, **kwargs)
 
     def check_call(self, adbargs, **kwargs):
-        return sp.check_call(self.adbcmd(adbargs), **kwargs)
+        status = self.call(adbargs, **kwargs)
+        if status:
+            raise sp.CalledProcessError(status, self.adbcmd(adbargs))
+        return 0
 
     def call(self, adbargs, **kwargs):
+        with self._traced(adbargs, kwargs) as ev:
+            ev['status'] = self._call(adbargs, **kwargs)
+            return ev['status']
+
+    def _call(self, adbargs, **kwargs):
+        if self._via_session(adbargs, kwargs):
+            r = self._session_run(adbargs)
+            if r is not None:
+                status, output = r
+                sys.stdout.buffer.write(output)
+                sys.stdout.flush()
+                return status
         return sp.call(self.adbcmd(adbargs), **kwargs)
+
+class AsyncAdbWrapper(object):
+    '''asyncio counterpart of AdbWrapper, for driving many devices from one event loop.'''
+
+    def __init__(self, adbbin='adb', devsel=()):
+        self.adbbin = adbbin
+        self.devsel = tuple(devsel)
+
+    def adbcmd(self, adbargs):
+        return (self.adbbin,) + self.devsel + tuple(adbargs)
+
+    async def check_output(self, adbargs, universal_newlines=True, stderr=None):
+        child = await asyncio.create_subprocess_exec(*self.adbcmd(adbargs), stdout=sp.PIPE, stderr=stderr)
+        output, _ = await child.communicate()
+        if universal_newlines:
+            output = output.decode().replace('\r\n','\n')
+        if child.returncode:
+            raise sp.CalledProcessError(child.returncode, self.adbcmd(adbargs), output)
+        return output
+
+    async def call(self, adbargs, **kwargs):
+        child = await asyncio.create_subprocess_exec(*self.adbcmd(adbargs), **kwargs)
+        return await child.wait()
+
+    async def pipe_out(self, adbargs, **kwargs):
+        return await asyncio.create_subprocess_exec(*self.adbcmd(adbargs), stdout=sp.PIPE, **kwargs)
+
+    async def get_version(self):
+        output = await self.check_output(('version',), stderr=sp.STDOUT)
+        m = re.search(r'^Android Debug Bridge version ((?:\d+.)+\d+)', output)
+        if not m:
+            raise RuntimeError("could not parse 'adb version' output")
+        return m.group(1), tuple(int(x) for x in m.group(1).split('.'))
+
+    async def get_serialno(self):
+        try:
+            serial = (await self.check_output(('get-serialno',), stderr=sp.DEVNULL)).strip()
+        except (OSError, sp.CalledProcessError):
+            return None
+        return serial if serial and serial!='unknown' else None
+
+    async def devices(self):
+        # [(serial, state, {'usb': '1-1.2', 'model': ..., ...}), ...] from 'adb devices -l'
+        devices = []
+        for l in (await self.check_output(('devices','-l'))).splitlines():
+            f = l.split()
+            if len(f) >= 2 and not l.startswith(('List of', '*')):
+                devices.append((f[0], f[1], dict(x.split(':',1) for x in f[2:] if ':' in x)))
+        return devices
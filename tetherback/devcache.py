@@ -0,0 +1,53 @@
+import os, json
+
+# Small per-device JSON cache, keyed by adb serial number, for things that
+# are slow to discover but rarely change (partition map, best transport, ...)
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tetherback')
+
+def cache_path(serial):
+    return os.path.join(cache_dir(), '%s.json' % serial.replace(os.sep, '_'))
+
+def shared_cache_path(name):
+    # caches which aren't about a device live in a subdirectory, so no serial can collide with them
+    return os.path.join(cache_dir(), 'shared', '%s.json' % name)
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _put(path, key, value):
+    d = _load(path)
+    d[key] = value
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(d, f, indent=1)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+def cache_load(serial):
+    if not serial:
+        return {}
+    return _load(cache_path(serial))
+
+def cache_get(serial, key, default=None):
+    return cache_load(serial).get(key, default)
+
+def cache_put(serial, key, value):
+    if not serial:
+        return
+    _put(cache_path(serial), key, value)
+
+def shared_cache_get(name, key, default=None):
+    return _load(shared_cache_path(name)).get(key, default)
+
+def shared_cache_put(name, key, value):
+    _put(shared_cache_path(name), key, value)
@@ -0,0 +1,156 @@
+import os, re, time, asyncio, argparse, subprocess as sp
+from sys import stderr
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from tabulate import tabulate
+
+from .adb_wrapper import AdbWrapper, AsyncAdbWrapper
+from .tetherback import make_parser, sensible_transport, build_partmap, plan_backup, create_backupdir, \
+    prepare_partition, backup_partition_retrying
+from .trace import Tracer
+from .xfer import RateLimit
+
+# Fleet mode: back up many devices at once from one event loop. Device checks
+# use AsyncAdbWrapper; partition map discovery, setup and transfers run the usual
+# blocking code on a thread pool. Each device gets its own directory
+# (OUTPUT/SERIAL/twrp-backup-...), trace and error handling; a global semaphore
+# limits concurrent transfers, and devices on the same USB bus share a RateLimit.
+
+# backup options which only make sense for a single device
+UNSUPPORTED = ('specific', 'jobs', 'incremental', 'store', 'stripes', 'dry_run', 'force', 'resume', 'sparse', 'verify_chunks',
+               'prometheus', 'verbose')
+
+def usb_bus(info):
+    # 'usb:1-1.4' from 'adb devices -l' is bus 1, port path 1.4
+    return info.get('usb', '?').split('-')[0]
+
+def parse_bus_limits(specs):
+    # ['2=35', '20'] -> {'2': 35e6, None: 20e6}
+    limits = {}
+    for spec in specs:
+        bus, _, rate = spec.rpartition('=')
+        limits[bus or None] = float(rate) * 1e6
+    return limits
+
+async def backup_device(serial, args, transport, transfers, limit, executor):
+    loop = asyncio.get_running_loop()
+    def run(fn, *a, **kw):
+        return loop.run_in_executor(executor, partial(fn, *a, **kw))
+
+    aadb = AsyncAdbWrapper('adb', ('-s', serial))
+    output = await aadb.check_output(('shell','twrp -v'))
+    if not re.search(r'TWRP version ((?:\d+.)+\d+)', output):
+        raise RuntimeError('device is not in TWRP recovery')
+
+    adb = AdbWrapper('adb', ('-s', serial))
+    adb.tracer = tracer = Tracer()
+    if args.session:
+        try:
+            await run(adb.start_session)
+        except (OSError, EOFError):
+            print("%s: WARNING: could not start persistent adb shell session; falling back to one adb process per command" % serial, file=stderr)
+    try:
+        partmap = await run(build_partmap, adb, serial=serial, rescan=args.rescan)
+        plan = plan_backup(args)
+        missing = set(plan) - set(partmap)
+        if missing:
+            raise RuntimeError('partitions not found in the partition map: %s' % ', '.join(missing))
+
+        dargs = argparse.Namespace(**vars(args))
+        dargs.output_path = os.path.join(args.output_path, serial)
+        backupdir = create_backupdir(dargs)
+    except BaseException:
+        adb.close_session()
+        raise
+    try:
+        for standard in sorted(plan, key=lambda standard: partmap[standard].size, reverse=True):
+            pi, bp = partmap[standard], plan[standard]
+            bp = bp._replace(fn=os.path.join(backupdir, bp.fn))
+            trace = tracer.partition(os.path.basename(bp.fn))
+            with trace.phase('setup'):
+                cmdline = await run(prepare_partition, adb, pi, bp, args.verify, args.host_gzip)
+            async with transfers:
+                await run(backup_partition_retrying, adb, pi, bp, transport, args.verify, cmdline=cmdline, retries=args.retries,
+                          host_gzip=args.host_gzip, trace=trace, limit=limit, show_progress=False, index=args.index)
+            print("%s: saved %s (%.1f MB/s)" % (serial, os.path.basename(bp.fn),
+                                                 (trace.as_dict()['throughput'] or 0)), file=stderr)
+    finally:
+        adb.close_session()
+        tracer.write_json(os.path.join(backupdir, 'tetherback-trace.json'))
+    return backupdir, len(plan), sum(pt.bytes for pt in tracer.partitions.values())
+
+async def fleet(args, serials, bus_limits):
+    aadb = AsyncAdbWrapper('adb')
+    adbversions, adbversion = await aadb.get_version()
+    print("Found ADB version %s" % adbversions, file=stderr)
+    transport = sensible_transport(args.transport, adbversion)
+
+    devices = {serial: (state, info) for serial, state, info in await aadb.devices()}
+    if not serials:
+        serials = [serial for serial, (state, info) in devices.items() if state == 'recovery']
+        if not serials:
+            raise RuntimeError('no devices in recovery found')
+    print("Backing up %d devices: %s" % (len(serials), ', '.join(serials)), file=stderr)
+
+    # devices on the same USB bus share its bandwidth limit
+    buses = {serial: usb_bus(devices.get(serial, (None, {}))[1]) for serial in serials}
+    limits = {bus: RateLimit(bus_limits.get(bus, bus_limits.get(None))) for bus in set(buses.values())
+              if bus_limits.get(bus, bus_limits.get(None))}
+
+    os.makedirs(args.output_path, exist_ok=True)
+    transfers = asyncio.Semaphore(args.transfers)
+    # threads for setup, plus the transfers themselves (each of which may use a few more)
+    executor = ThreadPoolExecutor(len(serials) + args.transfers)
+
+    async def one(serial):
+        t0 = time.monotonic()
+        try:
+            if serial not in devices:
+                raise RuntimeError('device not found')
+            elif devices[serial][0] != 'recovery':
+                raise RuntimeError('device is in %s mode, not recovery' % devices[serial][0])
+            backupdir, nfiles, nbytes = await backup_device(serial, args, transport, transfers, limits.get(buses[serial]), executor)
+        except Exception as e:
+            # one device's failure mustn't affect the others
+            print("%s: FAILED: %s" % (serial, e), file=stderr)
+            return [serial, buses[serial], 'FAILED', None, None, time.monotonic() - t0, None, str(e)]
+        elapsed = time.monotonic() - t0
+        return [serial, buses[serial], 'ok', nfiles, nbytes/(1<<20), elapsed, nbytes/elapsed/1e6, backupdir]
+
+    try:
+        return await asyncio.gather(*(one(serial) for serial in serials))
+    finally:
+        executor.shutdown()
+
+def fleet_main(args=None):
+    p = make_parser(prog='tetherback fleet',
+                    description='''Back up several devices in TWRP recovery at once; each device's backup goes in OUTPUT_PATH/SERIAL/.''')
+    g = p.add_argument_group('Fleet mode')
+    g.add_argument('serials', nargs='*', metavar='SERIAL', help='Devices to back up (default: every device in recovery, from adb devices)')
+    g.add_argument('-T', '--transfers', type=int, default=4, metavar='N', help='Maximum number of concurrent transfers across all devices (default %(default)s)')
+    g.add_argument('--bus-limit', action='append', default=[], metavar='[BUS=]MB/s',
+                   help='Limit the total transfer rate of the devices on USB bus BUS (or on every bus, without BUS=); may be repeated')
+    args = p.parse_args(args)
+
+    for opt in UNSUPPORTED:
+        if getattr(args, opt) != p.get_default(opt):
+            p.error("%s is not supported in fleet mode" % next(a.option_strings[-1] for a in p._actions if a.dest == opt))
+    if args.transport == 'auto':
+        p.error("--auto-transport is not supported in fleet mode")
+    if args.transfers < 1:
+        p.error("--transfers must be at least 1")
+    try:
+        bus_limits = parse_bus_limits(args.bus_limit)
+    except ValueError:
+        p.error("--bus-limit must be [BUS=]MB/s")
+
+    loop = asyncio.new_event_loop()
+    try:
+        rows = loop.run_until_complete(fleet(args, args.serials, bus_limits))
+    except (RuntimeError, OSError, sp.CalledProcessError) as e:
+        p.error(str(e))
+    finally:
+        loop.close()
+
+    print(tabulate(rows, ['Serial', 'USB bus', 'Status', 'Files', 'MiB', 'Time (s)', 'MB/s', 'Backup directory / error'], floatfmt='.1f'))
+    return 1 if any(r[2] != 'ok' for r in rows) else 0
@@ -0,0 +1,108 @@
+import os, io, re, glob, gzip
+from sys import stderr
+from collections import namedtuple
+
+from .store import RecipeReader, recipe_fn
+
+# Incremental raw-image backups: the device hashes fixed-size chunks of the
+# partition, and only chunks whose md5 differs from the previous backup's
+# manifest are transferred. The host rebuilds the full image from the previous
+# backup plus the changed chunks.
+
+IncrementalPlan = namedtuple('IncrementalPlan', 'chunksize size digests runs previous')
+
+# keep device-side command lines comfortably short
+RUNS_PER_COMMAND = 256
+
+def manifest_fn(fn):
+    return fn + '.chunks'
+
+def read_manifest(path):
+    # returns (chunksize, size, [md5, ...]), or None if missing or unreadable
+    try:
+        with open(path) as f:
+            m = re.match(r'# chunksize=(\d+) size=(\d+)$', f.readline().strip())
+            if not m:
+                print("WARNING: don't understand chunk manifest %s" % repr(path), file=stderr)
+                return None
+            return int(m.group(1)), int(m.group(2)), [l.strip() for l in f if l.strip()]
+    except OSError:
+        return None
+
+def write_manifest(path, chunksize, size, digests):
+    with open(path, 'w') as f:
+        print('# chunksize=%d size=%d' % (chunksize, size), file=f)
+        for d in digests:
+            print(d, file=f)
+
+def nchunks(size, chunksize):
+    return (size + chunksize - 1) // chunksize
+
+def chunk_md5_cmdline(devname, size, chunksize):
+    # device-side command line which prints the md5 of each chunk of the partition, one per line
+    return ('i=0; while [ $i -lt %d ]; do dd if=/dev/block/%s bs=%d skip=$i count=1 2>/dev/null | md5sum; i=$((i+1)); done'
+            % (nchunks(size, chunksize), devname, chunksize))
+
+def device_chunk_md5s(adb, devname, size, chunksize):
+    # One adb round-trip; the device reads the whole partition, but only sends the digests.
+    cmd = chunk_md5_cmdline(devname, size, chunksize)
+    digests = [l.split()[0] for l in adb.check_output(('shell',cmd)).splitlines() if l.strip()]
+    if len(digests) != nchunks(size, chunksize):
+        raise RuntimeError('%s: expected %d chunk digests from device, but got %d' % (devname, nchunks(size, chunksize), len(digests)))
+    return digests
+
+def changed_runs(old, new):
+    # coalesce indices of chunks that differ into (start, count) runs
+    runs = []
+    for ii, d in enumerate(new):
+        if ii < len(old) and old[ii] == d:
+            continue
+        elif runs and runs[-1][0] + runs[-1][1] == ii:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((ii, 1))
+    return runs
+
+def chunk_commands(devname, chunksize, runs):
+    # device-side command lines which send the chunks in runs, in order
+    for ii in range(0, len(runs), RUNS_PER_COMMAND):
+        batch = ' '.join('%d:%d' % r for r in runs[ii:ii+RUNS_PER_COMMAND])
+        yield ('for r in %s; do dd if=/dev/block/%s bs=%d skip=${r%%:*} count=${r#*:} 2>/dev/null; done'
+               % (batch, devname, chunksize))
+
+def has_backup_file(d, fn):
+    # either the file itself, or its recipe in a --store backup
+    return os.path.exists(os.path.join(d, fn)) or os.path.exists(os.path.join(d, recipe_fn(fn)))
+
+def find_previous_backup(output_path, btype, fn):
+    # most recent backup directory of this type containing fn and its chunk manifest
+    for d in sorted(glob.glob(os.path.join(output_path, btype + '-backup-*')), reverse=True):
+        if has_backup_file(d, fn) and os.path.exists(os.path.join(d, manifest_fn(fn))):
+            return d
+
+class StreamReader(object):
+    '''Exact-length reads from an iterator of byte blocks.'''
+
+    def __init__(self, block_iter):
+        self.block_iter = block_iter
+        self.buf = bytearray()
+
+    def read(self, n):
+        while len(self.buf) < n:
+            block = next(self.block_iter, None)
+            if block is None:
+                break
+            self.buf += block
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+def open_previous_image(prevdir, fn, store=None):
+    if not prevdir:
+        return None
+    elif os.path.exists(os.path.join(prevdir, fn)):
+        return gzip.open(os.path.join(prevdir, fn), 'rb')
+    elif store:
+        return gzip.GzipFile(fileobj=io.BufferedReader(RecipeReader(store, os.path.join(prevdir, recipe_fn(fn)))), mode='rb')
+    else:
+        raise RuntimeError("%s: previous backup of %s is in a --store repository" % (prevdir, fn))
@@ -0,0 +1,162 @@
+import os, re, zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+
+def gzip_member(data, level=6):
+    # A complete gzip member (RFC 1952) with mtime=0. Concatenated members form a
+    # valid multi-member gzip stream, which gunzip, busybox and TWRP all accept.
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+class ParallelGzipWriter(object):
+    '''File-like sink which gzips fixed-size chunks of its input on a thread pool
+    (zlib releases the GIL) and writes the resulting members to fileobj in order.
+    Keeps an md5 of the compressed output, for the .md5 file, and the (compressed,
+    uncompressed) offsets at which each member starts.'''
+
+    def __init__(self, fileobj, level=6, chunksize=4<<20, threads=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.chunksize = chunksize
+        threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(threads)
+        self.maxpending = 2*threads
+        self.pending = deque()
+        self.buf = bytearray()
+        self.md5 = md5()
+        self.compressed = 0
+        self.raw = 0
+        self.members = []
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= self.chunksize:
+            self._submit(bytes(self.buf[:self.chunksize]))
+            del self.buf[:self.chunksize]
+        return len(data)
+
+    def _submit(self, chunk):
+        self.pending.append((self.pool.submit(gzip_member, chunk, self.level), len(chunk)))
+        while len(self.pending) > self.maxpending:
+            self._drain_one()
+
+    def _drain_one(self):
+        future, size = self.pending.popleft()
+        member = future.result()
+        self.members.append((self.compressed, self.raw))
+        self.raw += size
+        self._output(member)
+        self.md5.update(member)
+        self.compressed += len(member)
+
+    def _output(self, member):
+        self.fileobj.write(member)
+
+    def tell(self):
+        return self.compressed
+
+    def close(self):
+        try:
+            if self.buf or not self.compressed and not self.pending:
+                # an empty input still needs one (empty) member to be a valid gzip file
+                self._submit(bytes(self.buf))
+                self.buf = bytearray()
+            while self.pending:
+                self._drain_one()
+        finally:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# The header of a member written by gzip_member (no name, mtime=0, any compression level)
+MEMBER_HEADER = re.compile(rb'\x1f\x8b\x08\x00\x00\x00\x00\x00[\x00\x02\x04]\x03')
+MAX_SEGMENT = 16<<20     # compressed; a bigger member is inflated in order
+INFLATE_BLOCK = 1<<20
+
+def _inflate_member(data):
+    # The contents of data if it is exactly one complete gzip member, else None
+    d = zlib.decompressobj(31)
+    try:
+        out = d.decompress(data, 64*MAX_SEGMENT)
+    except zlib.error:
+        return None
+    return out if d.eof and not d.unused_data and not d.unconsumed_tail else None
+
+class ParallelGunzip(object):
+    '''Iterator over the decompressed contents of a (multi-member) gzip file. The
+    members written by ParallelGzipWriter are found by their headers and inflated
+    on a thread pool; anything else, such as the single member from the device's
+    gzip, or a header-like byte sequence inside a member, is inflated in order.
+    Keeps an md5 of the compressed input, and counts it in consumed.'''
+
+    def __init__(self, fileobj, threads=None):
+        self.fileobj = fileobj
+        self.threads = threads or os.cpu_count() or 1
+        self.md5 = md5()
+        self.consumed = 0
+
+    def _segments(self, blocksize=1<<20):
+        # Splits the input at likely member headers: yields (data, whole), where
+        # whole means data might be exactly one member
+        buf, eof = bytearray(), False
+        while buf or not eof:
+            while not eof and len(buf) < MAX_SEGMENT + blocksize:
+                block = self.fileobj.read(blocksize)
+                eof = not block
+                self.md5.update(block)
+                buf += block
+            start = MEMBER_HEADER.match(buf) is not None
+            m = MEMBER_HEADER.search(buf, 1)
+            if m and m.start() <= MAX_SEGMENT:
+                cut, whole = m.start(), start
+            elif eof and len(buf) <= MAX_SEGMENT:
+                cut, whole = len(buf), start
+            else:
+                cut, whole = MAX_SEGMENT, False
+            yield bytes(buf[:cut]), whole
+            del buf[:cut]
+
+    def __iter__(self):
+        pool = ThreadPoolExecutor(self.threads)
+        pending = deque()
+        segments = self._segments()
+        d = None        # decompressor for a member being inflated in order
+        try:
+            while True:
+                while len(pending) < 2*self.threads:
+                    seg = next(segments, None)
+                    if seg is None:
+                        break
+                    data, whole = seg
+                    pending.append((data, pool.submit(_inflate_member, data) if whole else None))
+                if not pending:
+                    break
+                data, future = pending.popleft()
+                self.consumed += len(data)
+                out = future and future.result()
+                if d is None and out is not None:
+                    yield out
+                    continue
+                while True:
+                    if d is None:
+                        if not data:
+                            break
+                        d = zlib.decompressobj(31)
+                    out = d.decompress(data, INFLATE_BLOCK)
+                    if out:
+                        yield out
+                    if d.eof:
+                        data, d = d.unused_data, None
+                    else:
+                        data = d.unconsumed_tail
+                        if not data and len(out) < INFLATE_BLOCK:
+                            break
+            if d is not None:
+                raise EOFError("compressed file ended before the end-of-stream marker was reached")
+        finally:
+            pool.shutdown(cancel_futures=True)
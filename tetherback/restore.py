@@ -0,0 +1,253 @@
+import os, re, time, zlib, queue, socket, argparse, subprocess as sp
+from sys import stderr
+from hashlib import md5
+from collections import namedtuple, OrderedDict as odict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tabulate import tabulate
+
+from .adb_wrapper import AdbWrapper
+from .adb_stuff import *
+from .pgzip import ParallelGunzip
+from .sparse import unsparse_blocks, SparseImageError
+from .xfer import AsyncHasher, Throttle
+from .tetherback import adbxp, check_adb_version, check_TWRP, sensible_transport, build_partmap, md5_fifo, please_report, \
+    unmount_for_backup, progress_bar
+
+# Restore: stream the files of a backup directory straight into the device, with
+# no copy on its storage. The host decompresses (see ParallelGunzip) and checks
+# each file against its .md5 as it goes; the device writes raw images with dd,
+# or unpacks tarballs into the mounted filesystem, and hashes what it received,
+# which must match the md5 of the decompressed stream. Independent partitions
+# are restored concurrently. Sparse images (from --sparse) are expanded on the
+# host, with zeros for the unallocated blocks (which are sent over USB like the rest).
+
+RestorePlan = namedtuple('RestorePlan', 'fn istar sparse')
+
+# backup file names, as chosen by plan_backup: raw images are NAME.emmc.win (TWRP)
+# or NAME.tar.gz (nandroid), or NAME.simg.gz with --sparse; tarballs are NAME.ext4.win;
+# data is the userdata partition
+BACKUP_FN = re.compile(r'^(.+)\.(emmc\.win|tar\.gz|ext4\.win|simg\.gz)$')
+
+def plan_restore(backupdir):
+    plan = odict()
+    for fn in sorted(os.listdir(backupdir)):
+        m = BACKUP_FN.match(fn)
+        if m:
+            standard = 'userdata' if m.group(1) == 'data' else m.group(1)
+            plan[standard] = RestorePlan(fn, m.group(2) == 'ext4.win', m.group(2) == 'simg.gz')
+    return plan
+
+def status_fn(pi):
+    return '/tmp/restore.%s' % pi.devname
+
+def prepare_restore(adb, pi, rp, verify=True, wipe=False):
+    # Unmount the partition (raw images) or mount it read-write (tarballs), and
+    # create a FIFO for device-side md5 generation. Returns the device-side
+    # command line which consumes the decompressed stream; once it has finished,
+    # its exit status is in status_fn(pi).
+    md5in, md5out = md5_fifo(pi)
+    adb.check_call(('shell','rm -f %s %s %s 2> /dev/null%s' % (md5in, md5out, status_fn(pi), '; mknod %s p' % md5in if verify else '')))
+
+    if rp.istar:
+        print("Restoring tarball %s to %s (%s)..." % (rp.fn, pi.mountpoint, pi.devname))
+        if wipe:
+            # TWRP's own wipe, which keeps /data/media
+            adb.check_call(('shell','twrp wipe %s' % pi.mountpoint))
+        fstype = really_mount(adb, '/dev/block/'+pi.devname, pi.mountpoint, 'rw')
+        if not fstype:
+            raise RuntimeError('%s: could not mount %s' % (pi.partname, pi.mountpoint))
+        if fstype != pi.fstype:
+            raise RuntimeError('%s: expected %s filesystem, but found %s' % (pi.partname, pi.fstype, fstype))
+        cmdline = 'tar -xpC %s' % pi.mountpoint
+    else:
+        print("Restoring image %s to partition %s (%s)..." % (rp.fn, pi.partname, pi.devname))
+        unmount_for_backup(adb, pi)
+        cmdline = 'dd of=/dev/block/%s bs=1048576 2> /dev/null' % pi.devname
+
+    if verify:
+        cmdline = 'md5sum %s > %s & tee %s | %s' % (md5in, md5out, md5in, cmdline)
+    return '{ %s; echo $? > %s.tmp; wait; mv %s.tmp %s; }' % (cmdline, status_fn(pi), status_fn(pi), status_fn(pi))
+
+def open_sink(adb, pi, transport, cmdline):
+    # Run cmdline on the device, and return (write, close) for its input;
+    # close() sends EOF and tears down the transport.
+    if transport == adbxp.pipe_xo:
+        child = adb.pipe_in(('exec-in',cmdline), stdout=sp.DEVNULL)
+        write = child.stdin.write
+    else:
+        port = really_forward(adb, 5600+pi.partn, 5700+pi.partn)
+        if not port:
+            raise RuntimeError('%s: could not ADB-forward a TCP port' % pi.partname)
+        child = adb.pipe_out(('shell',tcp_in_cmdline(cmdline, port)), stdin=sp.DEVNULL)
+        s = connect_ready(port, child)
+        write = s.sendall
+
+    def close(abort=False):
+        if abort and child.poll() is None:
+            child.terminate()
+        if transport == adbxp.pipe_xo:
+            try:
+                child.stdin.close()
+            except BrokenPipeError:
+                pass
+            child.wait()
+        else:
+            if not abort:
+                s.shutdown(socket.SHUT_WR)
+            child.wait()
+            s.close()
+            if not really_unforward(adb, port) and not abort:
+                raise RuntimeError('could not remove ADB-forward for TCP port %d' % port)
+
+    return write, close
+
+def restore_partition(adb, pi, rp, path, transport, verify=True, wipe=False, line_offset=0):
+    # Returns (bytes restored, seconds)
+    cmdline = prepare_restore(adb, pi, rp, verify, wipe)
+    expected = None
+    if verify:
+        try:
+            with open(path+'.md5') as f:
+                expected = f.read().split()[0]
+        except (OSError, IndexError):
+            print("WARNING: %s has no .md5 file, so it can't be checked" % rp.fn, file=stderr)
+
+    t0 = time.monotonic()
+    write, close = open_sink(adb, pi, transport, cmdline)
+    pbar = progress_bar(rp.fn, os.path.getsize(path), line_offset)
+    progress = Throttle(lambda n: pbar.update(min(n, pbar.max_value)))
+
+    nbytes = 0
+    hasher = verify and AsyncHasher(md5())
+    try:
+        with open(path, 'rb') as f:
+            gz = ParallelGunzip(f)
+            for block in (unsparse_blocks(gz) if rp.sparse else gz):
+                nbytes += len(block)
+                if not rp.istar and nbytes > pi.size*512:
+                    raise RuntimeError("%s: image is larger than partition %s" % (rp.fn, pi.partname))
+                write(block)
+                if hasher:
+                    hasher.update(block)
+                progress(gz.consumed)
+        progress.flush()
+        pbar.finish()
+    except (zlib.error, EOFError, SparseImageError) as e:
+        close(abort=True)
+        raise RuntimeError("%s: backup file is corrupt (%s); partition %s is probably corrupt now!" % (rp.fn, e, pi.partname))
+    except BaseException:
+        close(abort=True)
+        raise
+    close()
+
+    md5in, md5out = md5_fifo(pi)
+    # wait (up to a minute) for the device-side command to finish writing
+    output = adb.check_output(('shell','i=0; while [ ! -e %s ] && [ $i -lt 60 ]; do sleep 1; i=$((i+1)); done; cat %s %s; rm -f %s %s %s'
+                               % (status_fn(pi), status_fn(pi), md5out if verify else '', status_fn(pi), md5in, md5out))).split()
+    if not output:
+        raise RuntimeError("%s: device-side command did not finish" % rp.fn)
+    elif output[0] != '0':
+        raise RuntimeError("%s: restoring on the device failed (exit status %s)" % (rp.fn, output[0]))
+    if verify:
+        localmd5 = gz.md5.hexdigest()
+        if expected and localmd5 != expected:
+            raise RuntimeError("%s: backup file doesn't match its .md5 (%s, expected %s); partition %s is probably corrupt now!"
+                               % (rp.fn, localmd5, expected, pi.partname))
+        devicemd5, rawmd5 = output[1:2], hasher.hexdigest()
+        if devicemd5 != [rawmd5]:
+            raise RuntimeError("%s: md5sum mismatch (local %s, device %s)" % (rp.fn, rawmd5, ''.join(devicemd5)))
+    return nbytes, time.monotonic() - t0
+
+def restore_all(adb, partmap, plan, backupdir, transport, verify=True, jobs=2, wipe=False):
+    # Largest files first, as for backups; returns a list of (file, partition, bytes, seconds)
+    order = sorted(plan, key=lambda standard: os.path.getsize(os.path.join(backupdir, plan[standard].fn)), reverse=True)
+    slots = queue.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+
+    def run(standard):
+        slot = slots.get()
+        try:
+            rp = plan[standard]
+            return (rp.fn, standard) + restore_partition(adb, partmap[standard], rp, os.path.join(backupdir, rp.fn),
+                                                         transport, verify, wipe, line_offset=slot)
+        finally:
+            slots.put(slot)
+
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = [pool.submit(run, standard) for standard in order]
+        try:
+            results = [f.result() for f in as_completed(futures)]
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+    adb.check_call(('shell','sync'))
+    return results
+
+def restore_main(args=None):
+    p = argparse.ArgumentParser(prog='tetherback restore', description='''Restore a backup made by tetherback to an Android device running TWRP recovery, streaming it over adb without copying it to the device's storage. Raw images are written to their partitions, and tarballs unpacked into their (mounted) filesystems.''')
+    p.add_argument('backupdir', help="Backup directory (twrp-backup-... or nandroid-backup-...)")
+    p.add_argument('partitions', nargs='*', metavar='PARTITION', help="Only restore these partitions (default: all of those in the backup directory)")
+    p.add_argument('-s', dest='specific', metavar='DEVICE_ID', default=None, help="Specific device ID (shown by adb devices). Default is sole USB-connected device.")
+    p.add_argument('-0', '--dry-run', action='store_true', help="Just show what would be restored where, then exit.")
+    p.add_argument('-V', '--no-verify', dest='verify', default=True, action='store_false', help="Don't check md5sums of the backup files and of the data written.")
+    p.add_argument('-j', '--jobs', type=int, default=2, metavar='N', help="Restore up to N partitions concurrently, largest first (default %(default)s).")
+    p.add_argument('--wipe', action='store_true', help="Wipe filesystems (with TWRP's wipe command, which keeps /data/media) before unpacking tarballs into them; otherwise files not in the backup are left alone.")
+    p.add_argument('--no-session', dest='session', default=True, action='store_false', help="Don't keep a persistent adb shell session open for short device-side commands.")
+    p.add_argument('--rescan', action='store_true', help="Ignore the cached partition map and rediscover it from the device.")
+    p.add_argument('-f', '--force', action='store_true', help="DANGEROUS! DO NOT USE! (Tries to proceed even if TWRP recovery is not detected.)")
+    g = p.add_argument_group('Data transfer methods', description="The default is --exec-in with adb v1.0.32 or newer, and --tcp with older versions.")
+    x = g.add_mutually_exclusive_group()
+    x.add_argument('-t','--tcp', dest='transport', action='store_const', const=adbxp.tcp, default=None, help="ADB TCP forwarding")
+    x.add_argument('-x','--exec-in', dest='transport', action='store_const', const=adbxp.pipe_xo, help="ADB exec-in binary pipe (only with newer versions of adb and TWRP)")
+    args = p.parse_intermixed_args(args)
+
+    if not os.path.isdir(args.backupdir):
+        p.error("%s is not a directory" % args.backupdir)
+    plan = plan_restore(args.backupdir)
+    if not plan:
+        if any(fn.endswith('.recipe') for fn in os.listdir(args.backupdir)):
+            p.error("%s was backed up with --store; use 'tetherback reassemble' first" % args.backupdir)
+        p.error("no backup files found in %s" % args.backupdir)
+    if args.partitions:
+        unknown = set(args.partitions) - set(plan)
+        if unknown:
+            p.error("no backup files for these partitions in %s: %s" % (args.backupdir, ', '.join(unknown)))
+        plan = odict((standard, rp) for standard, rp in plan.items() if standard in args.partitions)
+    if args.jobs < 1:
+        p.error("--jobs must be at least 1")
+
+    adb = AdbWrapper('adb', ('-s',args.specific) if args.specific else ('-d',))
+    adbversion = check_adb_version(p, adb)
+    args.transport = sensible_transport(args.transport, adbversion)
+    check_TWRP(p, adb, args.force)
+    if args.session:
+        try:
+            adb.start_session()
+        except (OSError, EOFError):
+            print("WARNING: could not start persistent adb shell session; falling back to one adb process per command", file=stderr)
+
+    try:
+        partmap = build_partmap(adb, serial=args.specific or adb.get_serialno(), rescan=args.rescan)
+        missing = set(plan) - set(partmap)
+        if missing:
+            p.error("The backup contains partitions which are not in the device's partition map: %s\n%s" % (', '.join(missing), please_report))
+        for standard, rp in plan.items():
+            if rp.istar and not partmap[standard].mountpoint:
+                p.error("%s is a tarball, but partition %s has no mountpoint in the device's fstab" % (rp.fn, standard))
+
+        print(tabulate([[rp.fn, standard, partmap[standard].devname, "tar -x into %s" % partmap[standard].mountpoint if rp.istar else "raw image"]
+                        for standard, rp in plan.items()], ['FILENAME', 'PARTITION NAME', 'DEVICE', 'RESTORE AS']), file=stderr)
+        if args.dry_run:
+            p.exit()
+
+        results = restore_all(adb, partmap, plan, args.backupdir, args.transport, args.verify, args.jobs, args.wipe)
+    except (RuntimeError, sp.CalledProcessError) as e:
+        p.error(str(e))
+    finally:
+        adb.close_session()
+
+    print("Restore complete.", file=stderr)
+    print(tabulate([[fn, standard, nbytes/(1<<20), t, nbytes/t/1e6] for fn, standard, nbytes, t in results],
+                   ['File', 'Partition', 'MiB', 'Time (s)', 'MB/s'], floatfmt='.1f'), file=stderr)
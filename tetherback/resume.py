@@ -0,0 +1,89 @@
+import os, zlib, shutil
+from hashlib import md5
+
+from .pgzip import ParallelGzipWriter
+
+# Resuming raw partition images. An interrupted backup leaves a gzip stream (one
+# member when the device compressed it, many with --host-compress) cut off at an
+# arbitrary point. salvage_gzip() keeps as much of it as decompresses cleanly,
+# rounded down to a multiple of RESUME_BS, and returns the md5 of that raw data.
+# The device can then check that prefix against the partition and send the rest
+# with dd skip=, which is appended to the file as further gzip members.
+
+RESUME_BS = 1<<20
+
+def _gunzip(f, chunk=1<<20):
+    # Yields (raw data, compressed offset of the end of the member if this completes
+    # one) from a multi-member gzip stream, stopping quietly where it's truncated or corrupt.
+    d, pos, data, eof = zlib.decompressobj(31), f.tell(), b'', False
+    try:
+        while True:
+            if not data and not eof:
+                data = f.read(chunk)
+                eof = not data
+            # bounded output: a megabyte of zeros compresses to about a kilobyte
+            out = d.decompress(data, chunk)
+            if d.eof:
+                pos += len(data) - len(d.unused_data)
+                data = d.unused_data
+                d = zlib.decompressobj(31)
+                yield out, pos
+            else:
+                pos += len(data) - len(d.unconsumed_tail)
+                data = d.unconsumed_tail
+                if out:
+                    yield out, None
+                elif eof:
+                    return
+    except zlib.error:
+        return
+
+def scan_gzip(path, bs=RESUME_BS):
+    # Returns ([(compressed end, raw end) of each complete member],
+    #          raw bytes intact rounded down to bs, md5 of those bytes)
+    members, h, snap, raw = [], md5(), md5(), 0
+    with open(path, 'rb') as f:
+        for out, end in _gunzip(f):
+            out = memoryview(out)
+            while out:
+                n = min(len(out), bs - raw % bs)
+                h.update(out[:n])
+                raw += n
+                out = out[n:]
+                if raw % bs == 0:
+                    snap = h.copy()
+            if end is not None:
+                members.append((end, raw))
+    return members, raw - raw % bs, snap.hexdigest()
+
+def salvage_gzip(path, bs=RESUME_BS, level=6):
+    # Cut a partial image back to its intact prefix, and return (raw offset, md5 of prefix)
+    members, offset, prefixmd5 = scan_gzip(path, bs)
+    cut, rawcut = max(((c, r) for c, r in members if r <= offset), default=(0, 0))
+    if rawcut < offset:
+        # the prefix ends inside a member, so recompress that part of it
+        tmp = path + '.salvage'
+        with open(path, 'rb') as f, open(tmp, 'wb') as out:
+            f.seek(cut)
+            with ParallelGzipWriter(out, level) as gz:
+                left = offset - rawcut
+                for data, end in _gunzip(f):
+                    gz.write(data[:left])
+                    left -= len(data[:left])
+                    if not left:
+                        break
+        with open(path, 'r+b') as f, open(tmp, 'rb') as t:
+            f.truncate(cut)
+            f.seek(cut)
+            shutil.copyfileobj(t, f, 1<<20)
+        os.unlink(tmp)
+    else:
+        os.truncate(path, cut)
+    return offset, prefixmd5
+
+def file_md5(path):
+    h = md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            h.update(block)
+    return h.hexdigest()
@@ -0,0 +1,251 @@
+import os, re, struct, argparse
+from sys import stderr
+from collections import namedtuple
+
+from .incremental import StreamReader
+from .pgzip import ParallelGunzip
+
+# Allocation-aware capture of raw ext4 images. The superblock, group descriptors
+# and block bitmaps are read from the device with dd, and only the allocated
+# blocks (plus all filesystem metadata) are transferred. The host writes them
+# as an Android sparse image (as used by fastboot; simg2img or 'tetherback
+# unsparse' turn it back into a full image), in which the unallocated blocks
+# are "don't care" chunks.
+#
+# Only ext4 without bigalloc or meta_bg is understood; for anything else
+# (including f2fs) the whole partition is captured as usual.
+
+SparsePlan = namedtuple('SparsePlan', 'blocksize blocks runs')
+Ext4Layout = namedtuple('Ext4Layout', 'blocksize blocks first_data_block blocks_per_group ngroups desc_size inode_table_blocks reserved_gdt_blocks sparse_super')
+
+EXT4_MAGIC = 0xEF53
+INCOMPAT_META_BG = 0x10
+INCOMPAT_64BIT = 0x80
+RO_COMPAT_SPARSE_SUPER = 0x1
+RO_COMPAT_BIGALLOC = 0x200
+BG_BLOCK_UNINIT = 0x2
+
+# free gaps smaller than this many bytes are transferred anyway, to keep the number of dd runs down
+MIN_GAP = 1<<20
+
+SPARSE_MAGIC = 0xed26ff3a
+CHUNK_RAW, CHUNK_FILL, CHUNK_DONT_CARE, CHUNK_CRC32 = 0xCAC1, 0xCAC2, 0xCAC3, 0xCAC4
+SPARSE_HEADER = struct.Struct('<IHHHHIIII')
+CHUNK_HEADER = struct.Struct('<HHII')
+
+class SparseImageError(RuntimeError):
+    pass
+
+def sparse_fn(fn):
+    # userdata.tar.gz -> userdata.simg.gz
+    return re.sub(r'(\.emmc\.win|\.tar\.gz)$', '', fn) + '.simg.gz'
+
+def parse_ext4_superblock(sb):
+    # sb is the 1 KiB at offset 1024 of the partition; returns None unless it's a supported ext4 filesystem
+    if len(sb) < 1024 or struct.unpack_from('<H', sb, 0x38)[0] != EXT4_MAGIC:
+        return None
+    inodes_count, blocks_lo, _, _, _, first_data_block, log_block_size, _, blocks_per_group, _, inodes_per_group = struct.unpack_from('<11I', sb, 0)
+    rev_level, = struct.unpack_from('<I', sb, 0x4C)
+    inode_size, = struct.unpack_from('<H', sb, 0x58) if rev_level else (128,)
+    compat, incompat, ro_compat = struct.unpack_from('<3I', sb, 0x5C)
+    reserved_gdt_blocks, = struct.unpack_from('<H', sb, 0xCE)
+    desc_size, = struct.unpack_from('<H', sb, 0xFE)
+    blocks_hi, = struct.unpack_from('<I', sb, 0x150)
+    if incompat & INCOMPAT_META_BG or ro_compat & RO_COMPAT_BIGALLOC or not blocks_per_group:
+        return None
+
+    blocksize = 1024 << log_block_size
+    blocks = blocks_lo | (blocks_hi << 32 if incompat & INCOMPAT_64BIT else 0)
+    ngroups = (blocks - first_data_block + blocks_per_group - 1) // blocks_per_group
+    return Ext4Layout(blocksize, blocks, first_data_block, blocks_per_group, ngroups,
+                      desc_size if incompat & INCOMPAT_64BIT else 32,
+                      (inodes_per_group * inode_size + blocksize - 1) // blocksize,
+                      reserved_gdt_blocks, bool(ro_compat & RO_COMPAT_SPARSE_SUPER))
+
+def gdt_blocks(layout):
+    return (layout.ngroups * layout.desc_size + layout.blocksize - 1) // layout.blocksize
+
+def parse_group_descriptors(layout, gdt):
+    # returns [(block bitmap, inode bitmap, inode table, flags)] for each group
+    groups = []
+    for g in range(layout.ngroups):
+        d = gdt[g*layout.desc_size:(g+1)*layout.desc_size]
+        bb, ib, it = struct.unpack_from('<3I', d, 0)
+        flags, = struct.unpack_from('<H', d, 0x12)
+        if layout.desc_size >= 64:
+            bb_hi, ib_hi, it_hi = struct.unpack_from('<3I', d, 0x20)
+            bb, ib, it = bb | bb_hi << 32, ib | ib_hi << 32, it | it_hi << 32
+        groups.append((bb, ib, it, flags))
+    return groups
+
+def has_super(layout, g):
+    # with sparse_super, only groups 0, 1 and powers of 3, 5 and 7 have backups of the superblock and GDT
+    if not layout.sparse_super or g <= 1:
+        return True
+    for base in (3, 5, 7):
+        n = base
+        while n < g:
+            n *= base
+        if n == g:
+            return True
+    return False
+
+def allocated_runs(layout, groups, bitmaps):
+    # Returns (start, count) runs of blocks to transfer: those marked in the block
+    # bitmaps (given for the groups without BLOCK_UNINIT, in order), plus all metadata.
+    # The bitmap (bit i is block first_data_block+i, as in the groups' bitmaps) is
+    # handled a byte (8 blocks) at a time, which errs on the side of copying.
+    fdb, bpg = layout.first_data_block, layout.blocks_per_group
+    bm = bytearray(layout.ngroups * bpg // 8)
+    def mark(block, count):
+        start, end = max(block - fdb, 0), block - fdb + count
+        if end > start:
+            bm[start//8:(end+7)//8] = b'\xff' * ((end+7)//8 - start//8)
+
+    bitmaps = iter(bitmaps)
+    for g, (bb, ib, it, flags) in enumerate(groups):
+        if not flags & BG_BLOCK_UNINIT:
+            data = next(bitmaps)[:bpg//8]
+            bm[g*bpg//8:g*bpg//8 + len(data)] = data
+        if has_super(layout, g):
+            mark(fdb + g*bpg, 1 + gdt_blocks(layout) + layout.reserved_gdt_blocks)
+        mark(bb, 1)
+        mark(ib, 1)
+        mark(it, layout.inode_table_blocks)
+
+    # the boot block(s) before the first group
+    runs = [(0, fdb)] if fdb else []
+    for m in re.finditer(rb'[^\x00]+', bm):
+        start, end = fdb + m.start()*8, min(fdb + m.end()*8, layout.blocks)
+        if start >= end:
+            break
+        if runs and (start - sum(runs[-1])) * layout.blocksize < MIN_GAP:
+            runs[-1] = (runs[-1][0], end - runs[-1][0])
+        else:
+            runs.append((start, end - start))
+    return runs
+
+class SparseImageWriter(object):
+    '''Writes an Android sparse image of total_blocks blocks to fileobj, in which
+    only the blocks in runs (start, count) are present; call write() with exactly
+    the data of those runs, in order.'''
+
+    def __init__(self, fileobj, blocksize, total_blocks, runs):
+        self.fileobj = fileobj
+        self.chunks = []
+        pos = 0
+        for start, count in runs:
+            if start > pos:
+                self.chunks.append((CHUNK_DONT_CARE, start - pos))
+            self.chunks.append((CHUNK_RAW, count))
+            pos = start + count
+        if pos < total_blocks:
+            self.chunks.append((CHUNK_DONT_CARE, total_blocks - pos))
+        self.blocksize = blocksize
+        fileobj.write(SPARSE_HEADER.pack(SPARSE_MAGIC, 1, 0, SPARSE_HEADER.size, CHUNK_HEADER.size,
+                                         blocksize, total_blocks, len(self.chunks), 0))
+        self.chunks.reverse()
+        self.left = 0       # bytes left in the current raw chunk
+        self._next_raw()
+
+    def _next_raw(self):
+        # write headers up to and including that of the next raw chunk
+        while self.chunks and not self.left:
+            ctype, count = self.chunks.pop()
+            size = count * self.blocksize if ctype == CHUNK_RAW else 0
+            self.fileobj.write(CHUNK_HEADER.pack(ctype, 0, count, CHUNK_HEADER.size + size))
+            self.left = size
+
+    def write(self, data):
+        n0, data = len(data), memoryview(data)
+        while data:
+            if not self.left:
+                raise RuntimeError("more data than the sparse image's runs")
+            n = min(len(data), self.left)
+            self.fileobj.write(data[:n])
+            self.left -= n
+            data = data[n:]
+            self._next_raw()
+        return n0
+
+    def complete(self):
+        return not self.left and not self.chunks
+
+def unsparse(blocks):
+    # Expands an Android sparse image, from an iterator of byte blocks, yielding
+    # (offset, data) for the data it contains and (offset, size) for the holes.
+    stream = StreamReader(iter(blocks))
+    hdr = stream.read(SPARSE_HEADER.size)
+    if len(hdr) < SPARSE_HEADER.size or SPARSE_HEADER.unpack(hdr)[0] != SPARSE_MAGIC:
+        raise SparseImageError("not an Android sparse image")
+    magic, major, minor, hdr_size, chunk_hdr_size, blocksize, total_blocks, total_chunks, checksum = SPARSE_HEADER.unpack(hdr)
+    stream.read(hdr_size - SPARSE_HEADER.size)
+    pos = 0
+    for ii in range(total_chunks):
+        chdr = stream.read(chunk_hdr_size)
+        if len(chdr) < CHUNK_HEADER.size:
+            raise SparseImageError("truncated sparse image")
+        ctype, _, count, total_size = CHUNK_HEADER.unpack_from(chdr)
+        size = count * blocksize
+        if ctype == CHUNK_RAW:
+            while size:
+                data = stream.read(min(size, 1<<20))
+                if not data:
+                    raise SparseImageError("truncated sparse image")
+                yield pos, data
+                pos += len(data)
+                size -= len(data)
+        elif ctype == CHUNK_FILL:
+            fill = stream.read(4)
+            for off in range(0, size, 1<<20):
+                yield pos, fill * (min(1<<20, size - off) // 4)
+                pos += min(1<<20, size - off)
+        elif ctype == CHUNK_DONT_CARE:
+            yield pos, size
+            pos += size
+        elif ctype == CHUNK_CRC32:
+            stream.read(4)
+        else:
+            raise SparseImageError("unknown sparse image chunk type 0x%04x" % ctype)
+    if pos != total_blocks * blocksize:
+        raise SparseImageError("sparse image has %d bytes of chunks, but should have %d" % (pos, total_blocks * blocksize))
+    if stream.read(1):
+        raise SparseImageError("trailing data after sparse image")
+
+def unsparse_blocks(blocks, zeros=bytes(1<<20)):
+    # the full image, as an iterator of byte blocks
+    for pos, data in unsparse(blocks):
+        if isinstance(data, int):
+            for off in range(0, data, len(zeros)):
+                yield zeros[:min(len(zeros), data - off)]
+        else:
+            yield data
+
+def open_image(path):
+    # an iterator of blocks of a file, decompressed if it's gzipped
+    f = open(path, 'rb')
+    if f.peek(2)[:2] == b'\x1f\x8b':
+        return f, iter(ParallelGunzip(f))
+    return f, iter(lambda: f.read(1<<20), b'')
+
+def unsparse_main(args=None):
+    p = argparse.ArgumentParser(prog='tetherback unsparse', description='''Turn a sparse raw image made with --sparse (an Android sparse image, optionally gzipped) back into a full image, written as a sparse file on the host.''')
+    p.add_argument('image', help="Sparse image (e.g. userdata.simg.gz)")
+    p.add_argument('output', nargs='?', help="Full image to write (default: IMAGE without .simg.gz, plus .img)")
+    args = p.parse_args(args)
+
+    output = args.output or re.sub(r'(\.simg)?(\.gz)?$', '', args.image) + '.img'
+    if output == args.image:
+        p.error("output would overwrite the input; please give an output filename")
+    f, blocks = open_image(args.image)
+    try:
+        with f, open(output, 'wb') as out:
+            for pos, data in unsparse(blocks):
+                if isinstance(data, int):
+                    out.seek(data, os.SEEK_CUR)
+                else:
+                    out.write(data)
+            out.truncate()
+    except (RuntimeError, EOFError) as e:
+        p.error("%s: %s" % (args.image, e))
+    print("Wrote %s (%d MiB)" % (output, os.path.getsize(output)>>20), file=stderr)
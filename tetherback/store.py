@@ -0,0 +1,214 @@
+import os, io, re, argparse, threading
+from sys import stderr
+from hashlib import md5, sha256
+from contextlib import contextmanager
+
+from .pgzip import ParallelGzipWriter
+
+# Content-addressed, deduplicating backup repository.
+#
+# Backup streams are transferred uncompressed and split into content-defined
+# chunks, each of which is gzipped into its own member; each member is stored
+# once under its sha256 in <repo>/objects/, and each backup file is recorded as a
+# small recipe (<fn>.recipe) listing its members, from which the exact file (a
+# multi-member gzip file) is reassembled. Since each member only depends on its
+# chunk, unchanged data gives the same members as in earlier backups, wherever
+# it is in the stream.
+#
+# Chunk boundaries are placed just after occurrences of a short marker sequence,
+# or at the start of a tar header, bounded by minimum and maximum chunk sizes.
+# Since the boundaries depend only on nearby content, an insertion or deletion
+# only disturbs the chunks around it; and since bytes.find() runs at memory
+# speed, chunking keeps up with the transfer.
+
+CDC_MARKER = b'\x8f\x3c'    # ~64 KiB between occurrences in high-entropy data
+TAR_MAGIC, TAR_MAGIC_OFFSET = b'ustar', 257
+CDC_MIN = 64<<10            # much smaller members would compress noticeably worse
+CDC_MAX = 1<<20
+
+def recipe_fn(fn):
+    return fn + '.recipe'
+
+class ChunkStore(object):
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def put(self, data):
+        # returns (digest, True if the chunk was new)
+        digest = sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a temporary file of our own, since other threads (with -j) may be storing the same chunk
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            if os.path.exists(path):
+                # stored by someone else in the meantime
+                return digest, False
+            raise
+        return digest, True
+
+    def get(self, digest):
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+
+class DedupWriter(ParallelGzipWriter):
+    '''Compressing sink which splits its (uncompressed) input into content-defined
+    chunks, gzips each of them into a member on a thread pool, stores the members
+    in a ChunkStore, and writes the recipe on close(). Like ParallelGzipWriter, keeps
+    an md5 of the compressed file, and the offsets of its members.'''
+
+    def __init__(self, store, path, level=6, threads=None):
+        super().__init__(None, level, CDC_MAX, threads)
+        self.store = store
+        self.path = path
+        self.scanned = 0
+        self.chunks = []
+        self.stored = 0
+
+    def write(self, data):
+        self.buf += data
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            self._submit(bytes(self.buf[:cut]))
+            del self.buf[:cut]
+            self.scanned = 0
+        return len(data)
+
+    def _find_cut(self):
+        if len(self.buf) < CDC_MIN:
+            return None
+        start = max(CDC_MIN, self.scanned)
+        cuts = []
+        pos = self.buf.find(CDC_MARKER, start, CDC_MAX)
+        if pos >= 0:
+            cuts.append(pos + len(CDC_MARKER))
+        pos = self.buf.find(TAR_MAGIC, start + TAR_MAGIC_OFFSET, CDC_MAX + TAR_MAGIC_OFFSET)
+        if pos >= 0:
+            cuts.append(pos - TAR_MAGIC_OFFSET)
+        if cuts:
+            return min(cuts)
+        elif len(self.buf) >= CDC_MAX:
+            return CDC_MAX
+        # don't rescan what we've already searched (but allow for a marker or tar header split across writes)
+        self.scanned = max(CDC_MIN, len(self.buf) - TAR_MAGIC_OFFSET - len(TAR_MAGIC) + 1)
+
+    def _output(self, member):
+        digest, new = self.store.put(member)
+        self.chunks.append((digest, len(member)))
+        if new:
+            self.stored += len(member)
+
+    def close(self):
+        super().close()
+        write_recipe(self.path, self.compressed, self.md5.hexdigest(), self.chunks)
+
+    def __exit__(self, exc_type, *exc):
+        # don't record a recipe for an incomplete stream
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.shutdown()
+
+@contextmanager
+def gzip_output(store, fn):
+    # The compressing sink for backup file fn: the file itself, or with a store,
+    # the store plus fn's recipe
+    if store:
+        with DedupWriter(store, recipe_fn(fn)) as sink:
+            yield sink
+    else:
+        with open(fn, 'wb') as out, ParallelGzipWriter(out) as sink:
+            yield sink
+
+def write_recipe(path, size, md5sum, chunks):
+    with open(path, 'w') as f:
+        print('# tetherback recipe size=%d md5=%s' % (size, md5sum), file=f)
+        for digest, length in chunks:
+            print(digest, length, file=f)
+
+def read_recipe(path):
+    # returns (size, md5, [(digest, length), ...])
+    with open(path) as f:
+        m = re.match(r'# tetherback recipe size=(\d+) md5=([0-9a-f]+)$', f.readline().strip())
+        if not m:
+            raise RuntimeError("%s: not a tetherback recipe" % path)
+        chunks = [(d, int(n)) for d, n in (l.split() for l in f if l.strip())]
+    return int(m.group(1)), m.group(2), chunks
+
+class RecipeReader(io.RawIOBase):
+    '''Read-only file object which reassembles a recipe from the store.'''
+
+    def __init__(self, store, path):
+        self.store = store
+        self.size, self.md5sum, self.chunks = read_recipe(path)
+        self.chunks.reverse()
+        self.buf = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf and self.chunks:
+            digest, length = self.chunks.pop()
+            data = self.store.get(digest)
+            if len(data) != length:
+                raise RuntimeError("chunk %s has length %d, expected %d" % (digest, len(data), length))
+            self.buf = memoryview(data)
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+def reassemble(store, recipe, outfn):
+    # Rebuild the exact backup file from its recipe, and check its size and md5
+    size, md5sum, chunks = read_recipe(recipe)
+    m, n = md5(), 0
+    with open(outfn, 'wb') as out:
+        for digest, length in chunks:
+            data = store.get(digest)
+            if len(data) != length or sha256(data).hexdigest() != digest:
+                raise RuntimeError("%s: corrupted chunk %s in store" % (recipe, digest))
+            out.write(data)
+            m.update(data)
+            n += len(data)
+    if (n, m.hexdigest()) != (size, md5sum):
+        raise RuntimeError("%s: reassembled %d bytes with md5 %s, expected %d bytes with md5 %s" % (recipe, n, m.hexdigest(), size, md5sum))
+    return md5sum
+
+########################################
+
+def reassemble_main(args=None):
+    p = argparse.ArgumentParser(prog='tetherback reassemble', description='''Reassemble the backup files (TWRP .win images and tarballs, with their .md5 files) of a backup made with --store.''')
+    p.add_argument('store', help="Backup repository (as given to --store)")
+    p.add_argument('backupdir', help="Backup directory containing .recipe files")
+    p.add_argument('-o', '--output-path', default=None, help="Where to write the reassembled files (default is the backup directory itself)")
+    args = p.parse_args(args)
+
+    store = ChunkStore(args.store)
+    outdir = args.output_path or args.backupdir
+    os.makedirs(outdir, exist_ok=True)
+    recipes = sorted(fn for fn in os.listdir(args.backupdir) if fn.endswith('.recipe'))
+    if not recipes:
+        p.error("no .recipe files found in %s" % args.backupdir)
+
+    for rfn in recipes:
+        fn = rfn[:-len('.recipe')]
+        print("Reassembling %s..." % fn, file=stderr)
+        md5sum = reassemble(store, os.path.join(args.backupdir, rfn), os.path.join(outdir, fn))
+        with open(os.path.join(outdir, fn+'.md5'), 'w') as md5out:
+            print('%s *%s' % (md5sum, fn), file=md5out)
+    print("Reassembled %d files in %s/" % (len(recipes), outdir), file=stderr)
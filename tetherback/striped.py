@@ -0,0 +1,85 @@
+import os, threading
+
+# Striped raw-image transfers: the partition is split into byte ranges which are
+# sent over separate TCP streams, and written into a preallocated file on the host
+# with positioned writes. A follower thread feeds the complete, contiguous prefix
+# of that file to the output sink (e.g. a ParallelGzipWriter) as it fills in.
+
+STRIPE_BS = 1<<20
+READ_SIZE = 1<<20
+
+def stripe_ranges(size, nstripes, bs=STRIPE_BS):
+    # (offset, length) byte ranges, each a whole number of bs-byte blocks except the last
+    nblocks = (size + bs - 1) // bs
+    per = (nblocks + nstripes - 1) // nstripes
+    return [(start*bs, min(per*bs, size - start*bs)) for start in range(0, nblocks, per)]
+
+class StripedFile(object):
+    def __init__(self, path, size, ranges, sink):
+        self.path = path
+        self.ranges = ranges
+        self.sink = sink
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(self.fd, size)
+        self.filled = [0] * len(ranges)
+        self.finished = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def pwrite(self, k, data):
+        offset, length = self.ranges[k]
+        if self.filled[k] + len(data) > length:
+            raise RuntimeError('stripe %d: received more than %d bytes' % (k, length))
+        pos = offset + self.filled[k]
+        while data:
+            n = os.pwrite(self.fd, data, pos)
+            data, pos = data[n:], pos + n
+        with self.cond:
+            self.filled[k] = pos - offset
+            self.cond.notify()
+
+    def prefix(self):
+        # end of the contiguous region which has been received
+        end = 0
+        for (offset, length), filled in zip(self.ranges, self.filled):
+            end = offset + filled
+            if filled < length:
+                break
+        return end
+
+    def _run(self):
+        pos = 0
+        try:
+            while True:
+                with self.cond:
+                    while self.prefix() <= pos and not self.finished:
+                        self.cond.wait()
+                    end, finished = self.prefix(), self.finished
+                while pos < end:
+                    data = os.pread(self.fd, min(READ_SIZE, end - pos), pos)
+                    self.sink.write(data)
+                    pos += len(data)
+                if finished:
+                    break
+        except Exception as e:
+            self.error = e
+
+    def close(self, remove=True):
+        # wait until everything received has gone to the sink
+        with self.cond:
+            self.finished = True
+            self.cond.notify()
+        self.thread.join()
+        os.close(self.fd)
+        if remove:
+            os.unlink(self.path)
+        if self.error:
+            raise self.error
+
+    def incomplete(self):
+        return [(k, filled, length) for k, ((offset, length), filled) in enumerate(zip(self.ranges, self.filled)) if filled != length]
@@ -0,0 +1,530 @@
+import os, re, sys, zlib, stat, time, bisect, fnmatch, tarfile, argparse, ctypes, ctypes.util
+from base64 import b64encode, b64decode
+from sys import stderr
+from collections import namedtuple
+
+# Seekable index for tarball backups. While a tarball streams in, the thread
+# which computes its md5 also inflates it, notes the offset of each tar member,
+# and every SPAN bytes records a checkpoint from which decompression can start
+# again: the compressed offset of a deflate block boundary, plus the 32 KiB of
+# uncompressed data before it (as in zlib's examples/zran.c). The index is
+# saved next to the tarball as NAME.idx; 'tetherback ls' lists a tarball from
+# the index alone, and 'tetherback extract' inflates from the nearest
+# checkpoint rather than from the start.
+#
+# Stopping at block boundaries (Z_BLOCK) and restarting mid-byte (inflatePrime)
+# aren't available from Python's zlib module, so those calls go to libz through
+# ctypes. Without a loadable libz, the only checkpoints are the starts of gzip
+# members (every 4 MiB with --host-compress, otherwise just the start).
+
+Checkpoint = namedtuple('Checkpoint', 'kind comp raw bits window')
+Member = namedtuple('Member', 'offset size mode mtime type name')
+TarIndex = namedtuple('TarIndex', 'size checkpoints members')
+
+SPAN = 8<<20
+WINDOW = 32<<10
+BLOCKSIZE = 512
+# tar member types which have no data following their header, even if their size isn't 0
+NO_DATA = b'123456'
+
+def index_fn(fn):
+    return fn + '.idx'
+
+### zlib's inflate() through ctypes
+
+Z_OK, Z_STREAM_END, Z_BUF_ERROR = 0, 1, -5
+Z_NO_FLUSH, Z_BLOCK = 0, 5
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint), ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p), ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int), ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong)]
+
+_libz = []
+def libz():
+    # the zlib shared library, or None if it can't be loaded
+    if not _libz:
+        lib = None
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library('z') or ('zlib1.dll' if sys.platform == 'win32' else 'libz.so.1'))
+            lib.zlibVersion.restype = ctypes.c_char_p
+            strm = ctypes.POINTER(_ZStream)
+            lib.inflateInit2_.argtypes = (strm, ctypes.c_int, ctypes.c_char_p, ctypes.c_int)
+            lib.inflatePrime.argtypes = (strm, ctypes.c_int, ctypes.c_int)
+            lib.inflateSetDictionary.argtypes = (strm, ctypes.c_char_p, ctypes.c_uint)
+            lib.inflate.argtypes = (strm, ctypes.c_int)
+            lib.inflateReset.argtypes = lib.inflateEnd.argtypes = (strm,)
+        except (OSError, AttributeError):
+            lib = None
+        _libz.append(lib)
+    return _libz[0]
+
+class Inflater(object):
+    '''A z_stream for inflate(). Output goes to a buffer which always keeps the last
+    WINDOW bytes of what came before, so that a checkpoint can be taken at any time.'''
+
+    def __init__(self, wbits, window=b'', bits=0, value=0, outsize=1<<20):
+        self.lib = libz()
+        self.strm = _ZStream()
+        self.ref = ctypes.byref(self.strm)
+        self._check(self.lib.inflateInit2_(self.ref, wbits, self.lib.zlibVersion(), ctypes.sizeof(self.strm)))
+        if bits:
+            self._check(self.lib.inflatePrime(self.ref, bits, value))
+        if window:
+            self._check(self.lib.inflateSetDictionary(self.ref, window, len(window)))
+        self.out = ctypes.create_string_buffer(WINDOW + outsize)
+        self.have = 0
+        self.input = None
+
+    def __del__(self):
+        if getattr(self, 'ref', None):
+            self.lib.inflateEnd(self.ref)
+
+    def _check(self, ret):
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            raise zlib.error('inflate error %d: %s' % (ret, (self.strm.msg or b'').decode(errors='replace')))
+        return ret
+
+    def feed(self, data):
+        self.input = (ctypes.c_char * len(data)).from_buffer_copy(data)
+        self.strm.next_in, self.strm.avail_in = ctypes.addressof(self.input), len(data)
+
+    def unused(self):
+        return ctypes.string_at(self.strm.next_in, self.strm.avail_in) if self.strm.avail_in else b''
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        # One call to inflate(); returns (return code, new output)
+        if self.have == len(self.out):
+            ctypes.memmove(self.out, ctypes.addressof(self.out) + self.have - WINDOW, WINDOW)
+            self.have = WINDOW
+        start = self.have
+        self.strm.next_out, self.strm.avail_out = ctypes.addressof(self.out) + start, len(self.out) - start
+        ret = self._check(self.lib.inflate(self.ref, flush))
+        self.have = len(self.out) - self.strm.avail_out
+        return ret, ctypes.string_at(ctypes.addressof(self.out) + start, self.have - start)
+
+    def window(self):
+        n = min(self.have, WINDOW)
+        return ctypes.string_at(ctypes.addressof(self.out) + self.have - n, n)
+
+    def reset(self):
+        # for the next member of a gzip stream
+        self._check(self.lib.inflateReset(self.ref))
+
+### Building the index
+
+def _number(field):
+    # octal, or base-256 for big values (GNU)
+    if field[0] & 0x80:
+        return int.from_bytes(field[1:], 'big')
+    return int(field.replace(b'\0', b' ').strip() or b'0', 8)
+
+def _name(b):
+    return b.decode('utf-8', 'surrogateescape')
+
+class TarScanner(object):
+    '''Follows a tar stream, fed in order to feed(), and lists its members. Each
+    member's offset is that of its first header, including any GNU long name or
+    pax extended header before it.'''
+
+    def __init__(self):
+        self.pos = 0
+        self.header = bytearray()
+        self.skip = 0           # bytes of member data (and padding) still to come
+        self.extended = None    # (type, size, data) of a long name or pax header
+        self.start = None
+        self.longname = None
+        self.pax = {}
+        self.members = []
+        self.done = False
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data and not self.done:
+            if self.skip:
+                n = min(self.skip, len(data))
+                if self.extended:
+                    self.extended[2].extend(data[:n])
+                self.skip -= n
+                if not self.skip and self.extended:
+                    self._extended(*self.extended)
+                    self.extended = None
+            else:
+                n = min(BLOCKSIZE - len(self.header), len(data))
+                self.header += data[:n]
+                if len(self.header) == BLOCKSIZE:
+                    self._header(bytes(self.header), self.pos + n - BLOCKSIZE)
+                    self.header = bytearray()
+            self.pos += n
+            data = data[n:]
+
+    def _header(self, h, offset):
+        if not h.strip(b'\0'):
+            self.done = True
+            return
+        if sum(h[:148]) + 8*32 + sum(h[156:]) != _number(h[148:156]):
+            raise ValueError('bad tar header checksum at offset %d' % offset)
+        if self.start is None:
+            self.start = offset
+        ttype, size = h[156:157].replace(b'\0', b'0'), _number(h[124:136])
+        self.skip = 0 if ttype in NO_DATA else (size + BLOCKSIZE - 1) // BLOCKSIZE * BLOCKSIZE
+        if ttype in b'LKxg':
+            self.extended = (ttype, size, bytearray())
+            if not self.skip:
+                self._extended(*self.extended)
+                self.extended = None
+            return
+
+        name = h[:100].split(b'\0', 1)[0]
+        if h[257:263] == b'ustar\0' and h[345]:
+            name = h[345:500].split(b'\0', 1)[0] + b'/' + name
+        name = self.longname or self.pax.get(b'path') or name
+        size = int(self.pax.get(b'size', size))
+        mtime = int(float(self.pax.get(b'mtime', _number(h[136:148]))))
+        self.members.append(Member(self.start, size, _number(h[100:108]) & 0o7777, mtime, ttype.decode(), _name(name)))
+        self.start, self.longname, self.pax = None, None, {}
+
+    def _extended(self, ttype, size, data):
+        data = bytes(data[:size])
+        if ttype == b'L':
+            self.longname = data.split(b'\0', 1)[0]
+        elif ttype == b'x':
+            # records are "LENGTH KEY=VALUE\n"
+            pos = 0
+            while pos < len(data):
+                length = int(data[pos:data.index(b' ', pos)])
+                key, value = data[data.index(b' ', pos)+1:pos+length-1].split(b'=', 1)
+                self.pax[key] = value
+                pos += length
+        elif ttype == b'g':
+            # a global header isn't part of the next member
+            self.start = None
+
+class TarIndexer(object):
+    '''Builds the index of a tarball from the bytes of the file, fed in order to
+    update() like a hashlib object (so that AsyncHasher or TailHasher can run it
+    on their thread). If gzipped is False, it's fed the uncompressed stream, and
+    the checkpoints are given to save() instead. Errors are kept rather than
+    raised: a tarball without an index is still a perfectly good backup.'''
+
+    def __init__(self, gzipped=True, span=SPAN):
+        self.gzipped = gzipped
+        self.span = span
+        self.scanner = TarScanner()
+        self.checkpoints = []
+        self.comp = self.raw = 0
+        self.inflater = Inflater(31) if gzipped and libz() else None
+        self.d = zlib.decompressobj(31) if gzipped and not libz() else None
+        self.member_start = True
+        self.error = None
+
+    def update(self, data):
+        if self.error:
+            return
+        try:
+            if not self.gzipped:
+                self._output(data)
+            elif self.inflater:
+                self._inflate(data)
+            else:
+                self._decompress(data)
+            self.comp += len(data)
+        except Exception as e:
+            self.error = e
+
+    def _output(self, out):
+        self.scanner.feed(out)
+        self.raw += len(out)
+
+    def _checkpoint(self, kind, comp, bits=0, window=b''):
+        if not self.checkpoints or self.raw - self.checkpoints[-1].raw >= self.span:
+            self.checkpoints.append(Checkpoint(kind, comp, self.raw, bits, window))
+
+    def _inflate(self, data):
+        inf = self.inflater
+        inf.feed(data)
+        while True:
+            ret, out = inf.inflate(Z_BLOCK)
+            self._output(out)
+            comp = self.comp + len(data) - inf.strm.avail_in
+            if ret == Z_STREAM_END:
+                inf.reset()
+            elif inf.strm.data_type & 128 and not inf.strm.data_type & 64:
+                # at the end of a deflate block (or of a gzip header); all its output has been
+                # delivered, and only the number of bits in data_type of the last byte remain
+                self._checkpoint('d', comp, inf.strm.data_type & 7, inf.window())
+            if ret == Z_BUF_ERROR or not inf.strm.avail_in and inf.strm.avail_out:
+                break
+
+    def _decompress(self, data):
+        # without libz, only the starts of gzip members are checkpoints
+        comp = self.comp
+        while data:
+            if self.member_start:
+                self._checkpoint('g', comp)
+                self.member_start = False
+            out = self.d.decompress(data, 1<<20)
+            self._output(out)
+            rest = self.d.unused_data if self.d.eof else self.d.unconsumed_tail
+            comp += len(data) - len(rest)
+            data = rest
+            if self.d.eof:
+                self.d = zlib.decompressobj(31)
+                self.member_start = True
+
+    def save(self, path, size=None, members=None):
+        # size is that of the (compressed) file, if it wasn't fed to update(); members are
+        # the (compressed, uncompressed) offsets of its gzip members (see ParallelGzipWriter)
+        if not self.error and not self.scanner.done:
+            self.error = ValueError('end of archive not found')
+        if self.error:
+            print("WARNING: couldn't index %s (%s)" % (path, self.error), file=stderr)
+            return None
+        checkpoints = self.checkpoints
+        if members is not None:
+            checkpoints = []
+            for comp, raw in members:
+                if not checkpoints or raw - checkpoints[-1].raw >= self.span:
+                    checkpoints.append(Checkpoint('g', comp, raw, 0, b''))
+        index = TarIndex(self.comp if size is None else size, checkpoints, self.scanner.members)
+        write_index(index_fn(path), index)
+        return index
+
+def build_index(path):
+    # index an existing tarball, by reading all of it
+    indexer = TarIndexer()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            indexer.update(block)
+    return indexer.save(path)
+
+### Index files
+
+def _escape(name):
+    return name.replace('\\', '\\\\').replace('\n', '\\n')
+
+def _unescape(name):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), name)
+
+def write_index(path, index):
+    with open(path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+        print('# tetherback index size=%d' % index.size, file=f)
+        for cp in index.checkpoints:
+            print('@%s %d %d %d %s' % (cp.kind, cp.comp, cp.raw, cp.bits, b64encode(zlib.compress(cp.window)).decode() if cp.window else '-'), file=f)
+        for m in index.members:
+            print('%d %d %o %d %s %s' % (m.offset, m.size, m.mode, m.mtime, m.type, _escape(m.name)), file=f)
+
+def read_index(path):
+    # returns a TarIndex, or None if missing or unreadable
+    try:
+        with open(path, encoding='utf-8', errors='surrogateescape') as f:
+            m = re.match(r'# tetherback index size=(\d+)$', f.readline().strip())
+            if not m:
+                print("WARNING: don't understand index %s" % repr(path), file=stderr)
+                return None
+            checkpoints, members = [], []
+            for l in f:
+                l = l.rstrip('\n')
+                if l.startswith('@'):
+                    kind, comp, raw, bits, window = l[1:].split(' ')
+                    checkpoints.append(Checkpoint(kind, int(comp), int(raw), int(bits), zlib.decompress(b64decode(window)) if window != '-' else b''))
+                elif l:
+                    offset, size, mode, mtime, ttype, name = l.split(' ', 5)
+                    members.append(Member(int(offset), int(size), int(mode, 8), int(mtime), ttype, _unescape(name)))
+            return TarIndex(int(m.group(1)), checkpoints, members)
+    except OSError:
+        return None
+    except (ValueError, zlib.error):
+        print("WARNING: index %s is corrupt" % repr(path), file=stderr)
+        return None
+
+### Reading from the index
+
+class IndexedTarball(object):
+    '''Read-only file object for the uncompressed contents of a gzipped tarball,
+    which seeks by inflating from the nearest checkpoint before the new position.'''
+
+    def __init__(self, path, index):
+        self.f = open(path, 'rb')
+        self.checkpoints = [cp for cp in index.checkpoints if cp.kind == 'g' or libz()]
+        if not self.checkpoints or self.checkpoints[0].raw:
+            self.checkpoints.insert(0, Checkpoint('g', 0, 0, 0, b''))
+        self.offsets = [cp.raw for cp in self.checkpoints]
+        self.pos = 0
+        self.stream = None
+        self.buf, self.bufpos = b'', 0      # the stream's last output, and its offset
+
+    def close(self):
+        self.f.close()
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        self.pos = pos + (self.pos if whence == os.SEEK_CUR else 0)
+        return self.pos
+
+    def _restart(self):
+        cp = self.checkpoints[bisect.bisect_right(self.offsets, self.pos) - 1]
+        if self.stream is None or self.pos < self.bufpos or cp.raw > self.bufpos + len(self.buf):
+            self.stream = self._inflate_from(cp)
+            self.buf, self.bufpos = b'', cp.raw
+
+    def _inflate_from(self, cp):
+        # yields the uncompressed data from checkpoint cp onwards
+        self.f.seek(cp.comp - (1 if cp.bits else 0))
+        data = b''
+        if cp.kind == 'd':
+            inf = Inflater(-15, cp.window, cp.bits, self.f.read(1)[0] >> (8 - cp.bits) if cp.bits else 0)
+            while True:
+                block = self.f.read(1<<20)
+                if not block:
+                    raise EOFError('compressed file ended before the end-of-stream marker was reached')
+                inf.feed(block)
+                ret = None
+                while ret != Z_STREAM_END and (inf.strm.avail_in or not inf.strm.avail_out):
+                    ret, out = inf.inflate()
+                    yield out
+                if ret == Z_STREAM_END:
+                    # skip the gzip trailer; any further members are inflated as usual
+                    data = inf.unused()
+                    while len(data) < 8:
+                        block = self.f.read(1<<20)
+                        if not block:
+                            return
+                        data += block
+                    data = data[8:]
+                    break
+        d = zlib.decompressobj(31)
+        while True:
+            if not data:
+                data = self.f.read(1<<20)
+                if not data:
+                    return
+            out = d.decompress(data, 1<<20)
+            yield out
+            if d.eof:
+                data, d = d.unused_data, zlib.decompressobj(31)
+            else:
+                data = d.unconsumed_tail
+
+    def read(self, n=-1):
+        self._restart()
+        chunks = []
+        while n:
+            if self.pos >= self.bufpos + len(self.buf):
+                self.bufpos += len(self.buf)
+                self.buf = next(self.stream, None)
+                if self.buf is None:
+                    self.buf, self.stream = b'', None
+                    break
+                continue
+            start = self.pos - self.bufpos
+            chunk = self.buf[start:start + n] if n > 0 else self.buf[start:]
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            n -= len(chunk) if n > 0 else 0
+        return b''.join(chunks)
+
+def open_index(path, rebuild=True, missing_ok=False):
+    # the tarball's index, building it if it's missing or out of date; raises OSError if the
+    # tarball can't be read, unless missing_ok and there's an index without it (e.g. with --store)
+    index = read_index(index_fn(path))
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        if index and missing_ok:
+            return index
+        raise
+    if index and index.size != size:
+        print("WARNING: index %s is out of date" % index_fn(path), file=stderr)
+        index = None
+    if not index and rebuild:
+        print("Indexing %s..." % path, file=stderr)
+        index = build_index(path)
+    return index
+
+def _relative(path):
+    # TWRP's tarballs have names like ./app/foo; match them with or without the ./ (or a /)
+    return re.sub(r'^(\./|/)+', '', path)
+
+def matches(member, patterns):
+    name = _relative(member.name)
+    return not patterns or any(fnmatch.fnmatchcase(name, _relative(p)) or name.startswith(_relative(p).rstrip('/') + '/')
+                               for p in patterns)
+
+TYPE_MODE = {'0': stat.S_IFREG, '7': stat.S_IFREG, '1': stat.S_IFREG, '2': stat.S_IFLNK, '3': stat.S_IFCHR,
+             '4': stat.S_IFBLK, '5': stat.S_IFDIR, '6': stat.S_IFIFO}
+
+def ls_main(args=None):
+    p = argparse.ArgumentParser(prog='tetherback ls', description='''List the contents of a tarball backup (e.g. data.ext4.win) from its index, which is built first if it's missing.''')
+    p.add_argument('tarball')
+    p.add_argument('patterns', nargs='*', metavar='PATTERN', help="Only list these files (shell-style wildcards), or the contents of these directories")
+    p.add_argument('-l', '--long', action='store_true', help="Show type, permissions, size and mtime")
+    args = p.parse_args(args)
+
+    try:
+        index = open_index(args.tarball, missing_ok=True)
+    except OSError as e:
+        p.error("couldn't index %s: %s" % (args.tarball, e.strerror or e))
+    if not index:
+        p.error("couldn't index %s" % args.tarball)
+    for m in index.members:
+        if matches(m, args.patterns):
+            if args.long:
+                print('%s %10d %s %s' % (stat.filemode(TYPE_MODE.get(m.type, stat.S_IFREG) | m.mode), m.size,
+                                         time.strftime('%Y-%m-%d %H:%M', time.localtime(m.mtime)), m.name))
+            else:
+                print(m.name)
+
+def extract_main(args=None):
+    p = argparse.ArgumentParser(prog='tetherback extract', description='''Extract files from a tarball backup (e.g. data.ext4.win), using its index to go straight to them rather than decompressing everything before them.''')
+    p.add_argument('tarball')
+    p.add_argument('patterns', nargs='+', metavar='PATTERN', help="Files to extract (shell-style wildcards), or directories to extract with their contents")
+    p.add_argument('-C', '--directory', default='.', help="Extract into this directory (default: the current one)")
+    p.add_argument('-O', '--to-stdout', action='store_true', help="Write the contents of files to standard output")
+    args = p.parse_args(args)
+
+    try:
+        index = open_index(args.tarball)
+    except OSError as e:
+        p.error("couldn't read %s: %s" % (args.tarball, e.strerror or e))
+    if not index:
+        p.error("couldn't index %s" % args.tarball)
+    wanted = [m for m in index.members if matches(m, args.patterns)]
+    if not wanted:
+        p.error("%s: nothing matches %s" % (args.tarball, ' '.join(args.patterns)))
+
+    f = IndexedTarball(args.tarball, index)
+    tf = tarfile.TarFile(fileobj=f)
+    # untrusted paths stay inside the directory (Python 3.12+, and some earlier updates)
+    kwargs = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+    failed = 0
+    t0 = time.monotonic()
+    try:
+        for m in wanted:
+            f.seek(m.offset)
+            ti = tarfile.TarInfo.fromtarfile(tf)
+            try:
+                if args.to_stdout:
+                    if ti.isreg():
+                        data = tf.extractfile(ti)
+                        for block in iter(lambda: data.read(1<<20), b''):
+                            sys.stdout.buffer.write(block)
+                else:
+                    tf.extract(ti, args.directory, **kwargs)
+            except (OSError, KeyError, tarfile.TarError) as e:
+                print("WARNING: couldn't extract %s: %s" % (ti.name, e), file=stderr)
+                failed += 1
+    except (EOFError, zlib.error, tarfile.TarError) as e:
+        p.error("%s: %s" % (args.tarball, e))
+    finally:
+        tf.close()
+        f.close()
+    print("Extracted %d of %d files in %.1f s" % (len(wanted) - failed, len(wanted), time.monotonic() - t0), file=stderr)
+    return 1 if failed else 0
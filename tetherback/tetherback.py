@@ -6,35 +6,55 @@
 # Excludes /data/media*, just as TWRP does
 
 import subprocess as sp
-import os, sys, datetime, socket, time, argparse, re
+import os, sys, datetime, time, argparse, re, queue, threading
 from sys import stderr
 from base64 import standard_b64decode as b64dec
-from progressbar import ProgressBar, Percentage, ETA, FileTransferSpeed, DataSize
+from progressbar import ProgressBar, NullBar, Percentage, ETA, FileTransferSpeed, DataSize
 from tabulate import tabulate
 from enum import Enum
 from hashlib import md5
 from collections import namedtuple, OrderedDict as odict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from .adb_wrapper import AdbWrapper
 from .adb_stuff import *
+from .devcache import cache_get, cache_put
+from .pgzip import ParallelGzipWriter
+from .incremental import IncrementalPlan, StreamReader, changed_runs, chunk_commands, chunk_md5_cmdline, device_chunk_md5s, \
+    find_previous_backup, has_backup_file, manifest_fn, nchunks, open_previous_image, read_manifest, write_manifest
+from .store import ChunkStore, DedupWriter, gzip_output, recipe_fn
+from .xfer import Source, AsyncHasher, TailHasher, Tee, Throttle, splice_to_file, can_splice
+from .striped import StripedFile, stripe_ranges, STRIPE_BS
+from .trace import Tracer, PartitionTrace
+from .resume import salvage_gzip, file_md5, RESUME_BS
+from .sparse import SparsePlan, SparseImageWriter, BG_BLOCK_UNINIT, parse_ext4_superblock, parse_group_descriptors, gdt_blocks, \
+    allocated_runs, sparse_fn
+from .tarindex import TarIndexer
 
 adbxp = Enum('AdbTransport', 'tcp pipe_xo pipe_b64 pipe_bin')
 PartInfo = namedtuple('PartInfo', 'partname devname partn size mountpoint fstype')
 BackupPlan = namedtuple('BackupPlan', 'fn taropts')
 
+RETRY_DELAY = 2 # seconds before retrying a failed transfer, doubled for each further retry
+
 please_report = """Please report this issue at https://github.com/dlenski/tetherback/issues
 Please post the entire output from tetherback!"""
 
 ########################################
 
-def parse_args(args=None):
-    p = argparse.ArgumentParser(description='''Tool to create TWRP and nandroid-style backups of an Android device running TWRP recovery, using adb-over-USB, without touching the device's internal storage or SD card.''')
+def make_parser(**kwargs):
+    p = argparse.ArgumentParser(**dict(dict(description='''Tool to create TWRP and nandroid-style backups of an Android device running TWRP recovery, using adb-over-USB, without touching the device's internal storage or SD card.'''), **kwargs))
     p.add_argument('-s', dest='specific', metavar='DEVICE_ID', default=None, help="Specific device ID (shown by adb devices). Default is sole USB-connected device.")
     p.add_argument('-o', '--output-path', default=".", help="Set optional output path for backup files.")
     p.add_argument('-N', '--nandroid', action='store_true', help="Make nandroid backup; raw images rather than tarballs for /system and /data partitions (default is TWRP backup)")
     p.add_argument('-0', '--dry-run', action='store_true', help="Just show the partition map and backup plan, then exit.")
     p.add_argument('-V', '--no-verify', dest='verify', default=True, action='store_false', help="Don't record and verify md5sum of backup files (default is to verify).")
     p.add_argument('-v', '--verbose', action='count', default=0)
+    p.add_argument('--no-session', dest='session', default=True, action='store_false', help="Don't keep a persistent adb shell session open for short device-side commands (start a new adb process for each).")
+    p.add_argument('--rescan', action='store_true', help="Ignore the cached partition map (and --auto-transport choice) and rediscover it from the device.")
+    p.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help="Back up up to N partitions concurrently, largest first (default %(default)s).")
+    p.add_argument('--retries', type=int, default=3, metavar='N', help="Retry a failed transfer (e.g. after a USB disconnect or adb server restart) up to N times; raw images resume where they left off (default %(default)s).")
+    p.add_argument('--resume', metavar='BACKUPDIR', default=None, help="Finish an interrupted backup in BACKUPDIR (use the same options as before): skip files already completed, and resume partial raw images.")
     p.add_argument('-f', '--force', action='store_true', help="DANGEROUS! DO NOT USE! (Tries to proceed even if TWRP recovery is not detected.)")
     g = p.add_argument_group('Data transfer methods',
                              description="The default is --exec-out with adb v1.0.32 or newer, and --tcp with older versions. If you have problems, please try --base64 for a slow but reliable transfer method (and report issues at http://github.com/dlenski/tetherback/issues)")
@@ -47,6 +67,26 @@ def parse_args(args=None):
                    help="Base64 pipe (very slow, should work with any host OS)")
     x.add_argument('-P','--pipe', dest='transport', action='store_const', const=adbxp.pipe_bin,
                    help="ADB shell binary pipe (fast, but probably only works on Linux hosts)")
+    g.add_argument('--stripes', type=int, default=1, metavar='N',
+                   help="With --tcp, send raw partition images as N parallel streams over separate forwarded ports, and compress them on the host (for devices where one adb stream can't fill a USB 3 link)")
+    x.add_argument('-A','--auto-transport', dest='transport', action='store_const', const='auto',
+                   help="Time a short transfer with each method, and use the fastest one which is 8-bit clean (remembered for each device; --rescan to probe again)")
+    g.add_argument('-Z', '--host-compress', dest='host_gzip', action='store_true', default=False,
+                   help="Transfer uncompressed data and gzip it on the host using all CPU cores (much faster over USB 2.0 or better; default is to gzip on the device, which is better for slow links)")
+    p.add_argument('--prometheus', metavar='FILE', default=None,
+                   help="Also write the timings of the backup (see tetherback-trace.json in the backup directory) as a Prometheus textfile, e.g. for node_exporter's textfile collector")
+    p.add_argument('--sparse', action='store_true', default=False,
+                   help="Only transfer the allocated blocks of raw images of ext4 filesystems (read from the allocation bitmaps), and save them as gzipped Android sparse images (NAME.simg.gz; 'tetherback unsparse' turns them back into full images). Images are compressed on the host. Restoring doesn't benefit: the unallocated blocks are written as zeros, which are sent over USB like the rest.")
+    p.add_argument('--verify-chunks', action='store_true', default=False,
+                   help="Check raw images a chunk at a time as they arrive (the device hashes each --chunk-size chunk alongside the transfer), instead of only checking the md5 of the whole image at the end; a bad chunk stops the transfer, and only that chunk is read again. Also writes a chunk manifest (NAME.chunks), which later --incremental backups can use. Images are compressed on the host.")
+    p.add_argument('--no-index', dest='index', default=True, action='store_false',
+                   help="Don't build an index of each tarball (NAME.idx) while it's transferred; the index lets 'tetherback ls' and 'tetherback extract' go straight to the files in it.")
+    p.add_argument('--store', metavar='REPO', default=None,
+                   help="Deduplicate backup files into the content-addressed repository REPO, saving a small .recipe file for each in the backup directory (use 'tetherback reassemble' to recreate the files). Backups are compressed on the host, in chunks which only change where the data does.")
+    g = p.add_argument_group('Incremental raw-image backups')
+    g.add_argument('-I', '--incremental', nargs='?', const='', default=None, metavar='PREVDIR',
+                   help="Only transfer the chunks of raw partition images which changed since a previous backup made with this option (default: the most recent one in the output path). Images are compressed on the host.")
+    g.add_argument('--chunk-size', type=int, default=4, metavar='MiB', help="Chunk size for incremental backups and --verify-chunks (default %(default)s MiB)")
     g = p.add_argument_group('Backup contents')
     g.add_argument('-M', '--media', action='store_true', default=False, help="Include /data/media* in TWRP backup")
     g.add_argument('-D', '--data-cache', action='store_true', default=False, help="Include /data/*-cache in TWRP backup")
@@ -56,6 +96,10 @@ def parse_args(args=None):
     g.add_argument('-S', '--no-system', dest='system', action='store_false', default=True, help="Omit /system partition from backup")
     g.add_argument('-B', '--no-boot', dest='boot', action='store_false', default=True, help="Omit boot partition from backup")
     g.add_argument('-X', '--extra', action='append', dest='extra', metavar='NAME', default=[], help="Include extra partition as raw image")
+    return p
+
+def parse_args(args=None):
+    p = make_parser()
     return p, p.parse_args(args)
 
 def check_adb_version(p, adb):
@@ -119,18 +163,86 @@ def sensible_transport(transport, adbversion):
             return adbxp.tcp
     return transport
 
-def build_partmap(adb, mmcblk='mmcblk0', fstab='/etc/fstab'):
-    # build partition map
-    partmap = odict()
-    fstab = fstab_dict(adb, fstab)
-    d = uevent_dict(adb, '/sys/block/%s/uevent' % mmcblk)
+def probe_transport(adb, transport, size=4<<20, timeout=30):
+    # Time a few MB of /dev/urandom through transport, and check that it arrives
+    # 8-bit clean (md5 computed on the device). Returns MB/s, or None if broken.
+    probe = PartInfo('transport probe', None, 0, size//512, None, None)
+    fifo, out = '/tmp/md5in.probe', '/tmp/md5out.probe'
+    try:
+        adb.check_call(('shell','rm -f %s %s 2> /dev/null; mknod %s p' % (fifo, out, fifo)))
+        t0 = time.monotonic()
+        source, close = open_stream(adb, probe, transport,
+                                    '{ md5sum %s > %s & dd if=/dev/urandom bs=65536 count=%d 2> /dev/null | tee %s; wait; }' % (fifo, out, size//65536, fifo))
+        localmd5, nbytes = md5(), 0
+        watchdog = threading.Timer(timeout, source.kill)
+        watchdog.start()
+        try:
+            for block in source.blocks():
+                localmd5.update(block)
+                nbytes += len(block)
+        except BaseException:
+            # don't leave the adb child (or the TCP forward) behind for the next candidate
+            close(abort=True)
+            raise
+        finally:
+            watchdog.cancel()
+        close()
+        elapsed = time.monotonic() - t0
+        devicemd5 = adb.check_output(('shell','cat %s && rm -f %s %s' % (out, fifo, out))).strip().split()[0]
+    except (sp.CalledProcessError, OSError, RuntimeError, IndexError) as e:
+        print("  %s: failed (%s)" % (transport.name, e), file=stderr)
+        adb.call(('shell','rm -f %s %s 2> /dev/null' % (fifo, out)))
+        return None
+    if nbytes != size or devicemd5 != localmd5.hexdigest():
+        print("  %s: data corrupted (%d bytes received, %d expected)" % (transport.name, nbytes, size), file=stderr)
+        return None
+    rate = size / elapsed / 1e6
+    print("  %s: %.1f MB/s" % (transport.name, rate), file=stderr)
+    return rate
+
+def auto_transport(adb, adbversion, serial=None, rescan=False):
+    # Pick the fastest transport which works, and remember it for this device and adb version
+    adbversions = '.'.join(map(str, adbversion))
+    cached = cache_get(serial, 'transport')
+    if cached and cached['adb']==adbversions and cached['transport'] in adbxp.__members__ and not rescan:
+        print("Using cached fastest transfer method for this device: %s" % cached['transport'], file=stderr)
+        return adbxp[cached['transport']]
+
+    candidates = [adbxp.pipe_xo, adbxp.pipe_bin, adbxp.tcp, adbxp.pipe_b64]
+    if adbversion < (1,0,32):
+        candidates.remove(adbxp.pipe_xo)
+    print("Probing transfer methods...", file=stderr)
+    rates = {t: probe_transport(adb, t) for t in candidates}
+    working = {t: r for t, r in rates.items() if r}
+    if not working:
+        raise RuntimeError("no transfer method works with this device\n" + please_report)
+    best = max(working, key=working.get)
+    print("Using fastest transfer method: %s" % best.name, file=stderr)
+    cache_put(serial, 'transport', dict(adb=adbversions, transport=best.name, rates={t.name: r for t, r in rates.items()}))
+    return best
+
+def build_partmap(adb, mmcblk='mmcblk0', fstab='/etc/fstab', serial=None, rescan=False):
+    # reuse cached partition map, unless the partition table or fstab has changed
+    fingerprint = device_fingerprint(adb, '/proc/partitions', fstab) if serial else None
+    cached = cache_get(serial, 'partmap', {}).get(mmcblk)
+    if fingerprint and cached and cached['fingerprint']==fingerprint and not rescan:
+        print("Using cached partition map for %s (%d partitions)" % (mmcblk, len(cached['partitions'])), file=stderr)
+        return odict((standard, PartInfo(*pi)) for standard, pi in cached['partitions'])
+
+    # fetch fstab and all the partition uevents and sizes in a single adb round-trip
+    sysblock = '/sys/block/%s' % mmcblk
+    files = cat_files(adb, fstab, sysblock+'/uevent', '%s/%sp*/uevent' % (sysblock, mmcblk), '%s/%sp*/size' % (sysblock, mmcblk))
+    fstab = parse_fstab(files.get(fstab, ()), fstab)
+    d = parse_uevent(files.get(sysblock+'/uevent', ()), sysblock+'/uevent')
     nparts = int(d['NPARTS'])
     print("Reading partition map for %s (%d partitions)..." % (mmcblk, nparts), file=stderr)
-    pbar = ProgressBar(max_value=nparts, widgets=['  partition map: ', Percentage(), ' ', ETA()]).start()
+
+    partmap = odict()
     for ii in range(1, nparts+1):
-        d = uevent_dict(adb, '/sys/block/%s/%sp%d/uevent'%(mmcblk, mmcblk, ii))
+        path = '%s/%sp%d' % (sysblock, mmcblk, ii)
+        d = parse_uevent(files[path+'/uevent'], path+'/uevent')
         devname, partn = d['DEVNAME'], int(d['PARTN'])
-        size = int(adb.check_output(('shell','cat /sys/block/%s/%sp%d/size'%(mmcblk, mmcblk, ii))))
+        size = int(files[path+'/size'][0])
         mountpoint, fstype = fstab.get('/dev/block/%s'%d['DEVNAME'], (None, None))
 
         # some devices have uppercase names, see #14
@@ -147,10 +259,12 @@ def build_partmap(adb, mmcblk='mmcblk0', fstab='/etc/fstab'):
             standard = partname
 
         partmap[standard] = PartInfo(partname, devname, partn, size, mountpoint, fstype)
-        pbar.update(ii)
-    else:
-        pbar.finish()
-        return partmap
+
+    if fingerprint:
+        cache = cache_get(serial, 'partmap', {})
+        cache[mmcblk] = dict(fingerprint=fingerprint, partitions=list(partmap.items()))
+        cache_put(serial, 'partmap', cache)
+    return partmap
 
 def plan_backup(args):
     # Build table of partitions requested for backup
@@ -194,10 +308,37 @@ def create_backupdir(args, timestamp=None):
     os.mkdir(backupdir)
     return backupdir
 
-def backup_partition(adb, pi, bp, transport, verify=True):
-    # Create a FIFO for device-side md5 generation
+def md5_cmdline(pi, cmdline):
+    # have the device md5 the output of cmdline as it goes, through the FIFO from md5_fifo(pi);
+    # wait for md5sum, so that its output is complete once the stream has ended
+    md5in, md5out = md5_fifo(pi)
+    return '{ md5sum %s > %s & %s | tee %s; wait; }' % (md5in, md5out, cmdline, md5in)
+
+class Md5Mismatch(RuntimeError):
+    '''The device's md5 of a stream which it sent in full differs from ours.'''
+
+def check_device_md5(adb, pi, localmd5, what=''):
+    md5in, md5out = md5_fifo(pi)
+    devicemd5 = adb.check_output(('shell','cat %s && rm -f %s %s' % (md5out, md5in, md5out))).split()
+    if not devicemd5:
+        # the device-side command didn't finish: the stream was cut short, rather than corrupted
+        raise EOFError("no md5sum from device%s (was the transfer interrupted?)" % what)
+    if devicemd5[0] != localmd5:
+        raise Md5Mismatch("md5sum mismatch%s (local %s, device %s)" % (what, localmd5, devicemd5[0]))
+
+def md5_fifo(pi, stripe=None):
+    # per-partition (and per-stripe) FIFO and result file, so that concurrent backups don't collide
+    suffix = pi.devname if stripe is None else '%s.%d' % (pi.devname, stripe)
+    return '/tmp/md5in.%s' % suffix, '/tmp/md5out.%s' % suffix
+
+def prepare_partition(adb, pi, bp, verify=True, host_gzip=False, skip=0):
+    # Mount/unmount the partition, and create a FIFO for device-side md5 generation.
+    # Returns the device-side command line which produces the backup stream
+    # (uncompressed with host_gzip, in which case the md5 is of the raw stream).
+    # For a raw image, skip is where to resume, a multiple of RESUME_BS.
+    md5in, md5out = md5_fifo(pi)
     if verify:
-        adb.check_call(('shell','rm -f /tmp/md5in /tmp/md5out 2> /dev/null; mknod /tmp/md5in p'))
+        adb.check_call(('shell','rm -f %s %s 2> /dev/null; mknod %s p' % (md5in, md5out, md5in)))
 
     if bp.taropts:
         print("Saving tarball of %s (mounted at %s), %d MiB uncompressed..." % (pi.devname, pi.mountpoint, pi.size/2048))
@@ -206,25 +347,35 @@ def backup_partition(adb, pi, bp, transport, verify=True):
             raise RuntimeError('%s: could not mount %s' % (pi.partname, pi.mountpoint))
         if fstype != pi.fstype:
             raise RuntimeError('%s: expected %s filesystem, but found %s' % (pi.partname, pi.fstype, fstype))
-        cmdline = 'tar -czC %s %s . 2> /dev/null' % (pi.mountpoint, bp.taropts or '')
+        cmdline = 'tar -c%sC %s %s . 2> /dev/null' % ('' if host_gzip else 'z', pi.mountpoint, bp.taropts or '')
     else:
-        print("Saving partition %s (%s), %d MiB uncompressed..." % (pi.partname, pi.devname, pi.size/2048))
-        if not really_umount(adb, '/dev/block/'+pi.devname, pi.mountpoint):
-            raise RuntimeError('%s: could not unmount %s' % (pi.partname, pi.mountpoint))
-        cmdline = 'dd if=/dev/block/%s 2> /dev/null | gzip -f' % pi.devname
+        if skip:
+            print("Resuming partition %s (%s) at %d of %d MiB..." % (pi.partname, pi.devname, skip>>20, pi.size/2048))
+        else:
+            print("Saving partition %s (%s), %d MiB uncompressed..." % (pi.partname, pi.devname, pi.size/2048))
+        unmount_for_backup(adb, pi)
+        if skip:
+            cmdline = 'dd if=/dev/block/%s bs=%d skip=%d 2> /dev/null' % (pi.devname, RESUME_BS, skip//RESUME_BS)
+        else:
+            cmdline = 'dd if=/dev/block/%s 2> /dev/null' % pi.devname
+        if not host_gzip:
+            cmdline += ' | gzip -f'
 
     if verify:
-        cmdline = 'md5sum /tmp/md5in > /tmp/md5out & %s | tee /tmp/md5in' % cmdline
-        localmd5 = md5()
+        cmdline = md5_cmdline(pi, cmdline)
+    return cmdline
 
+def open_stream(adb, pi, transport, cmdline):
+    # Run cmdline on the device, and return (Source, close) for its output;
+    # close() waits for the device command and tears down the transport.
     if transport == adbxp.pipe_bin:
         # need stty -onlcr to make adb-shell an 8-bit-clean pipe: http://stackoverflow.com/a/20141481/20789
         child = adb.pipe_out(('shell','stty -onlcr && '+cmdline))
-        block_iter = iter(lambda: child.stdout.read(65536), b'')
+        source = Source(child.stdout.raw.readinto, child.stdout.fileno(), child=child)
     elif transport == adbxp.pipe_b64:
         # pipe output through base64: excruciatingly slow
         child = adb.pipe_out(('shell',cmdline+'| base64'))
-        block_iter = iter(lambda: b64dec(b''.join(child.stdout.readlines(65536))), b'')
+        source = Source(block_iter=iter(lambda: b64dec(b''.join(child.stdout.readlines(65536))), b''), child=child)
     elif transport == adbxp.pipe_xo:
         # use adb exec-out, which is
         # (a) only available with newer versions of adb on the host, and
@@ -232,59 +383,588 @@ def backup_partition(adb, pi, bp, transport, verify=True):
         # https://plus.google.com/110558071969009568835/posts/Ar3FdhknHo3
         # https://android.googlesource.com/platform/system/core/+/5d9d434efadf1c535c7fea634d5306e18c68ef1f/adb/commandline.c#1244
         child = adb.pipe_out(('exec-out',cmdline))
-        block_iter = iter(lambda: child.stdout.read(65536), b'')
+        source = Source(child.stdout.raw.readinto, child.stdout.fileno(), child=child)
     else:
         port = really_forward(adb, 5600+pi.partn, 5700+pi.partn)
         if not port:
-            raise RuntimeError('%s: could not ADB-forward a TCP port')
-        child = adb.pipe_out(('shell',cmdline + '| nc -l -p%d -w3'%port))
+            raise RuntimeError('%s: could not ADB-forward a TCP port' % pi.partname)
+        child = adb.pipe_out(('shell',tcp_cmdline(cmdline, port)))
+        s = connect_ready(port, child)
+        source = Source(s.recv_into, s.fileno(), is_socket=True, child=child)
 
-        # FIXME: need a better way to check that socket is ready to transmit
-        time.sleep(1)
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('localhost', port))
-        block_iter = iter(lambda: s.recv(65536), b'')
+    def close(abort=False):
+        # after a failed transfer, just clean up as much as possible
+        if abort:
+            source.kill()
+        child.wait()
+        if transport==adbxp.tcp:
+            s.close()
+            if not really_unforward(adb, port) and not abort:
+                raise RuntimeError('could not remove ADB-forward for TCP port %d' % port)
 
-    pbwidgets = ['  %s: ' % bp.fn, Percentage(), ' ', ETA(), ' ', FileTransferSpeed(), ' ', DataSize() ]
-    pbar = ProgressBar(max_value=pi.size*512, widgets=pbwidgets).start()
+    return source, close
 
-    with open(bp.fn, 'wb') as out:
-        for block in block_iter:
-            out.write(block)
-            if verify:
-                localmd5.update(block)
-            pbar.update(out.tell())
+def unmount_for_backup(adb, pi):
+    # raw images are read (or written) with the filesystem unmounted, so that it isn't changing under us
+    if not really_umount(adb, '/dev/block/'+pi.devname, pi.mountpoint):
+        raise RuntimeError('%s: could not unmount %s' % (pi.partname, pi.mountpoint))
+
+def progress_bar(fn, size, line_offset=0, show=True):
+    # a started progress bar for transferring size bytes of fn, on line line_offset (with -j)
+    pbwidgets = ['  %s: ' % fn, Percentage(), ' ', ETA(), ' ', FileTransferSpeed(), ' ', DataSize() ]
+    return (ProgressBar if show else NullBar)(max_value=size, widgets=pbwidgets, **({'line_offset': line_offset} if line_offset else {})).start()
+
+def backup_partition(adb, pi, bp, transport, verify=True, cmdline=None, line_offset=0, host_gzip=False, store=None, trace=None,
+                     limit=None, show_progress=True, skip=0, index=False):
+    # skip is the size of the raw image already in the file, when resuming
+    trace = trace or PartitionTrace(bp.fn)
+    if cmdline is None:
+        with trace.phase('setup'):
+            cmdline = prepare_partition(adb, pi, bp, verify, host_gzip)
+
+    t_open = time.monotonic()
+    source, close = open_stream(adb, pi, transport, cmdline)
+    trace.source(source)
+    try:
+        hasher, sink = stream_partition(pi, bp, source, verify, line_offset, host_gzip, store, trace, t_open, limit, show_progress, skip, index)
+    except BaseException:
+        close(abort=True)
+        raise
+
+    with trace.phase('verify'):
+        if verify:
+            localmd5 = hasher.hexdigest()
+            check_device_md5(adb, pi, localmd5)
+            # with host_gzip, the device and local md5s are of the raw stream, but the .md5 file is of the compressed file;
+            # when resuming, they only cover the part just transferred
+            filemd5 = file_md5(bp.fn) if skip else sink.md5.hexdigest() if host_gzip else localmd5
+            with open(bp.fn+'.md5', 'w') as md5out:
+                print('%s *%s' % (filemd5, os.path.basename(bp.fn)), file=md5out)
+
+        close()
+
+def stream_partition(pi, bp, source, verify, line_offset, host_gzip, store, trace, t_open, limit, show_progress, skip, index=False):
+    # Save the stream to bp.fn, returning (hasher, sink)
+    pbar = progress_bar(bp.fn, pi.size*512 - skip, line_offset, show_progress)
+    progress = Throttle(lambda n: pbar.update(min(n, pbar.max_value)))
+
+    nbytes = 0
+    # a tarball is indexed by the thread which hashes it, from the bytes of the file
+    # (or with host_gzip, from the raw stream, plus the offsets of the gzip members)
+    indexer = TarIndexer(gzipped=not host_gzip) if index and bp.taropts is not None else None
+    h = Tee(md5(), indexer) if indexer else md5()
+    # with a store, the (raw) stream is recorded as deduplicated gzip members plus a recipe
+    with (DedupWriter(store, recipe_fn(bp.fn)) if store else open(bp.fn, 'r+b' if skip else 'wb')) as out:
+        if skip:
+            # not O_APPEND, which splice() won't write to
+            out.seek(0, os.SEEK_END)
+        sink = out
+        if can_splice and source.fd is not None and not (host_gzip or store):
+            # zero-copy: the kernel moves the data from the pipe or socket to the file,
+            # and the md5 is computed from the page cache on another thread
+            hasher = (verify or indexer) and TailHasher(h, bp.fn, out.tell())
+            nbytes = splice_to_file(source, out.fileno(), progress, hasher, limit)
+        else:
+            # with host_gzip, the device sends the raw stream and we compress it on all cores
+            hasher = (verify or indexer) and AsyncHasher(h)
+            sink = ParallelGzipWriter(out) if host_gzip and not store else out
+            for block in source.blocks(hasher):
+                sink.write(block)
+                nbytes += len(block)
+                progress(nbytes)
+                if limit:
+                    limit(len(block))
+            if host_gzip and not store:
+                sink.close()
+        if not host_gzip:
+            pbar.max_value = nbytes or pbar.max_value # need to adjust for the smaller compressed size
+        progress.flush()
+        pbar.finish()
+        trace.streamed(t_open, nbytes)
+    if store:
+        print("  %s: %d of %d KiB were new to the repository" % (bp.fn, out.stored>>10, out.compressed>>10), file=stderr)
+    if indexer:
+        with trace.phase('index'):
+            hasher.hexdigest()
+            indexer.save(bp.fn, *((sink.tell(), sink.members) if host_gzip else ()))
+    return hasher, sink
+
+def resume_partition(adb, pi, bp, transport, verify=True, host_gzip=False, trace=None, **kwargs):
+    # Keep the intact part of a partial raw image and transfer the rest. The device
+    # checks the md5 of the part that's kept, and the md5 of the rest is checked as
+    # usual, so that between them they verify the whole image.
+    trace = trace or PartitionTrace(bp.fn)
+    with trace.phase('setup'):
+        skip, prefixmd5 = salvage_gzip(bp.fn) if os.path.exists(bp.fn) else (0, None)
+        cmdline = prepare_partition(adb, pi, bp, verify, host_gzip, skip)
+        if skip and verify:
+            devicemd5 = adb.check_output(('shell','dd if=/dev/block/%s bs=%d count=%d 2> /dev/null | md5sum'
+                                          % (pi.devname, RESUME_BS, skip//RESUME_BS))).split()
+            if devicemd5[:1] != [prefixmd5]:
+                print("WARNING: %s: partial image doesn't match the partition; starting again" % bp.fn, file=stderr)
+                skip = 0
+                cmdline = prepare_partition(adb, pi, bp, verify, host_gzip)
+    backup_partition(adb, pi, bp, transport, verify, cmdline=cmdline, host_gzip=host_gzip, trace=trace, skip=skip, **kwargs)
+
+def backup_partition_retrying(adb, pi, bp, transport, verify=True, cmdline=None, retries=0, resume=False, **kwargs):
+    # Retry failed transfers without rediscovering anything: after a broken stream, or
+    # any other adb or transport failure (e.g. the device going offline for a moment),
+    # raw images pick up where they left off (except with a store), since resume_partition
+    # checks the part which is kept against the device anyway. Tarballs, and anything
+    # which failed verification (and so is known to be bad), start again from scratch.
+    for attempt in range(retries + 1):
+        try:
+            if resume and bp.taropts is None and not kwargs.get('store'):
+                return resume_partition(adb, pi, bp, transport, verify, **kwargs)
+            return backup_partition(adb, pi, bp, transport, verify, cmdline=cmdline, **kwargs)
+        except (OSError, EOFError, RuntimeError, sp.CalledProcessError) as e:
+            if attempt == retries:
+                raise
+            delay = RETRY_DELAY << attempt
+            print("WARNING: %s: transfer failed (%s); retrying in %d seconds (%d of %d)..." % (bp.fn, e, delay, attempt+1, retries), file=stderr)
+            time.sleep(delay)
+            cmdline, resume = None, not isinstance(e, Md5Mismatch)
+
+def prepare_incremental(adb, pi, bp, prevdir=None, chunksize=4<<20):
+    # Unmount the partition, have the device hash its chunks, and compare them
+    # with the chunk manifest of the previous backup (if any).
+    print("Saving partition %s (%s) incrementally, %d MiB uncompressed..." % (pi.partname, pi.devname, pi.size/2048))
+    unmount_for_backup(adb, pi)
+
+    size = pi.size*512
+    digests = device_chunk_md5s(adb, pi.devname, size, chunksize)
+    old = []
+    if prevdir:
+        m = read_manifest(os.path.join(prevdir, manifest_fn(bp.fn)))
+        if m and m[:2]==(chunksize, size) and has_backup_file(prevdir, bp.fn):
+            old = m[2]
+        else:
+            print("WARNING: %s has no usable chunk manifest for %s; sending all chunks" % (prevdir, bp.fn), file=stderr)
+            prevdir = None
+
+    runs = changed_runs(old, digests)
+    print("  %s: %d of %d chunks changed%s" % (bp.fn, sum(count for start, count in runs), len(digests),
+                                             ' since %s' % prevdir if prevdir else ''))
+    return IncrementalPlan(chunksize, size, digests, runs, prevdir)
+
+def backup_partition_incremental(adb, pi, bp, transport, ip, verify=True, line_offset=0, store=None, trace=None):
+    # Rebuild the full image from the previous backup and the changed chunks,
+    # checking every chunk against the device's md5
+    trace = trace or PartitionTrace(bp.fn)
+    nbytes = [0]
+    def blocks():
+        for cmdline in chunk_commands(pi.devname, ip.chunksize, ip.runs):
+            source, close = open_stream(adb, pi, transport, cmdline)
+            for block in trace.source(source).blocks():
+                nbytes[0] += len(block)
+                yield block
+            close()
+
+    t_open = time.monotonic()
+    stream = StreamReader(blocks())
+    changed = set(ii for start, count in ip.runs for ii in range(start, start+count))
+    prev = open_previous_image(ip.previous, bp.fn, store)
+
+    pbar = progress_bar(bp.fn, ip.size, line_offset)
+
+    with gzip_output(store, bp.fn) as sink:
+        for ii, digest in enumerate(ip.digests):
+            length = min(ip.chunksize, ip.size - ii*ip.chunksize)
+            old = prev.read(length) if prev else None # keep the previous image in step
+            chunk = stream.read(length) if ii in changed else old
+            if len(chunk) != length or md5(chunk).hexdigest() != digest:
+                raise RuntimeError("%s: chunk %d does not match device md5 (%s)" % (bp.fn, ii, 'transferred' if ii in changed else 'from '+ip.previous))
+            sink.write(chunk)
+            pbar.update(ii*ip.chunksize + length)
         else:
-            pbar.max_value = out.tell() or pbar.max_value # need to adjust for the smaller compressed size
             pbar.finish()
+    if prev:
+        prev.close()
+    if stream.read(1):
+        raise RuntimeError("%s: device sent more data than expected" % bp.fn)
+    trace.streamed(t_open, nbytes[0])
 
-    if verify:
-        devicemd5 = adb.check_output(('shell','cat /tmp/md5out && rm -f /tmp/md5in /tmp/md5out')).strip().split()[0]
-        localmd5 = localmd5.hexdigest()
-        if devicemd5 != localmd5:
-            raise RuntimeError("md5sum mismatch (local %s, device %s)" % (localmd5, devicemd5))
+    with trace.phase('verify'):
+        write_manifest(manifest_fn(bp.fn), ip.chunksize, ip.size, ip.digests)
+        if verify:
+            with open(bp.fn+'.md5', 'w') as md5out:
+                print('%s *%s' % (sink.md5.hexdigest(), os.path.basename(bp.fn)), file=md5out)
+
+def prepare_chunked(adb, pi, bp):
+    print("Saving partition %s (%s) with chunk-by-chunk verification, %d MiB uncompressed..." % (pi.partname, pi.devname, pi.size/2048))
+    unmount_for_backup(adb, pi)
+
+def backup_partition_chunked(adb, pi, bp, transport, chunksize=4<<20, retries=0, line_offset=0, store=None, trace=None):
+    # Stream the raw image while the device hashes its chunks alongside (on another
+    # adb stream), and check each chunk as soon as it arrives. At a bad chunk, the
+    # stream is stopped, just that chunk is read again (up to retries times), and
+    # the stream restarts after it. The chunk manifest can seed later -I backups.
+    trace = trace or PartitionTrace(bp.fn)
+    size = pi.size*512
+    n = nchunks(size, chunksize)
+    hashing = adb.pipe_out(('shell', chunk_md5_cmdline(pi.devname, size, chunksize)))
+    digests = []
+    def device_digest(ii):
+        while len(digests) <= ii:
+            l = hashing.stdout.readline()
+            if not l:
+                raise RuntimeError('%s: expected %d chunk digests from device, but got %d' % (pi.devname, n, len(digests)))
+            elif l.strip():
+                digests.append(l.split()[0].decode())
+        return digests[ii]
+
+    nbytes = [0]
+    def blocks(source):
+        for block in trace.source(source).blocks():
+            nbytes[0] += len(block)
+            yield block
+    def read_chunk(stream, length):
+        # a broken stream just gives a short (and so bad) chunk
+        try:
+            return stream.read(length)
+        except (OSError, EOFError):
+            return b''
+
+    pbar = progress_bar(bp.fn, size, line_offset)
+    progress = Throttle(lambda n: pbar.update(min(n, pbar.max_value)))
+
+    t_open = time.monotonic()
+    stream = close = None
+    refetched = 0
+    try:
+        with gzip_output(store, bp.fn) as sink:
+            for ii in range(n):
+                length = min(chunksize, size - ii*chunksize)
+                if stream is None:
+                    source, close = open_stream(adb, pi, transport, 'dd if=/dev/block/%s bs=%d skip=%d 2> /dev/null' % (pi.devname, chunksize, ii))
+                    stream = StreamReader(blocks(source))
+                chunk = read_chunk(stream, length)
+                attempt = 0
+                while len(chunk) != length or md5(chunk).hexdigest() != device_digest(ii):
+                    # don't bother receiving the rest of a stream which has gone bad
+                    if stream:
+                        close(abort=True)
+                        stream = None
+                    if attempt == retries:
+                        raise RuntimeError("%s: chunk %d does not match device md5%s" % (bp.fn, ii, ' after %d attempts' % (retries+1) if retries else ''))
+                    attempt += 1
+                    print("WARNING: %s: chunk %d does not match device md5; reading it again (%d of %d)..." % (bp.fn, ii, attempt, retries), file=stderr)
+                    source, close1 = open_stream(adb, pi, transport, next(chunk_commands(pi.devname, chunksize, [(ii, 1)])))
+                    chunk = read_chunk(StreamReader(blocks(source)), length)
+                    close1(abort=len(chunk) != length)
+                refetched += bool(attempt)
+                sink.write(chunk)
+                progress(ii*chunksize + length)
+            if stream:
+                if stream.read(1):
+                    raise RuntimeError("%s: device sent more data than expected" % bp.fn)
+                close()
+                stream = None
+            progress.flush()
+            pbar.finish()
+    except BaseException:
+        if stream:
+            close(abort=True)
+        hashing.kill()
+        raise
+    finally:
+        hashing.wait()
+    trace.streamed(t_open, nbytes[0])
+    if refetched:
+        print("  %s: %d of %d chunks had to be read again" % (bp.fn, refetched, n), file=stderr)
+
+    with trace.phase('verify'):
+        write_manifest(manifest_fn(bp.fn), chunksize, size, digests)
         with open(bp.fn+'.md5', 'w') as md5out:
-            print('%s *%s' % (localmd5, bp.fn), file=md5out)
+            print('%s *%s' % (sink.md5.hexdigest(), os.path.basename(bp.fn)), file=md5out)
+
+def device_read(adb, pi, transport, bs, runs, retries=0):
+    # the blocks in runs (start, count) of the partition, in order; always checked
+    # against the device's md5 (even with --no-verify), since they decide what a
+    # sparse image leaves out, and reading them again up to retries times
+    data = bytearray()
+    for cmdline in chunk_commands(pi.devname, bs, runs):
+        for attempt in range(retries + 1):
+            md5in, md5out = md5_fifo(pi)
+            adb.check_call(('shell','rm -f %s %s 2> /dev/null; mknod %s p' % (md5in, md5out, md5in)))
+            source, close = open_stream(adb, pi, transport, md5_cmdline(pi, cmdline))
+            got = bytearray()
+            try:
+                for block in source.blocks():
+                    got += block
+            except BaseException:
+                close(abort=True)
+                raise
+            close()
+            try:
+                check_device_md5(adb, pi, md5(got).hexdigest(), ' reading %s' % pi.devname)
+                break
+            except (Md5Mismatch, EOFError) as e:
+                if attempt == retries:
+                    raise
+                print("WARNING: %s; reading it again (%d of %d)..." % (e, attempt+1, retries), file=stderr)
+        data += got
+    if len(data) != bs * sum(count for start, count in runs):
+        raise RuntimeError('%s: expected %d bytes from device, but got %d' % (pi.devname, bs * sum(count for start, count in runs), len(data)))
+    return bytes(data)
+
+def prepare_sparse(adb, pi, bp, transport, retries=0):
+    # Unmount the partition, and read its ext4 allocation bitmaps. Returns a
+    # SparsePlan, or None if there's no ext4 filesystem there which we understand.
+    unmount_for_backup(adb, pi)
+    size = pi.size*512
+    layout = parse_ext4_superblock(device_read(adb, pi, transport, 1024, [(1, 1)], retries))
+    if not layout or size % layout.blocksize or layout.blocks * layout.blocksize > size:
+        print("WARNING: %s doesn't contain an ext4 filesystem which --sparse understands; saving all of it" % pi.partname, file=stderr)
+        return None
+
+    groups = parse_group_descriptors(layout, device_read(adb, pi, transport, layout.blocksize, [(layout.first_data_block + 1, gdt_blocks(layout))], retries))
+    wanted = [bb for bb, ib, it, flags in groups if not flags & BG_BLOCK_UNINIT]
+    runs = []
+    for bb in wanted:
+        if runs and sum(runs[-1]) == bb:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((bb, 1))
+    data = device_read(adb, pi, transport, layout.blocksize, runs, retries)
+    runs = allocated_runs(layout, groups, (data[ii*layout.blocksize:(ii+1)*layout.blocksize] for ii in range(len(wanted))))
+
+    # anything after the filesystem (such as a crypto footer) is transferred too
+    blocks = size // layout.blocksize
+    if layout.blocks < blocks:
+        runs.append((layout.blocks, blocks - layout.blocks))
+    used = sum(count for start, count in runs) * layout.blocksize
+    print("Saving partition %s (%s) sparsely, %d of %d MiB allocated..." % (pi.partname, pi.devname, used>>20, size>>20))
+    return SparsePlan(layout.blocksize, blocks, runs)
+
+def backup_partition_sparse(adb, pi, bp, transport, sparse_plan, verify=True, line_offset=0, store=None, trace=None):
+    # Transfer the allocated runs, checking each batch of them against the
+    # device's md5, and write them as a gzipped sparse image
+    trace = trace or PartitionTrace(bp.fn)
+    fn = sparse_fn(bp.fn)
+    pbar = progress_bar(fn, sum(count for start, count in sparse_plan.runs) * sparse_plan.blocksize, line_offset)
+    progress = Throttle(lambda n: pbar.update(min(n, pbar.max_value)))
+
+    t_open = time.monotonic()
+    nbytes = 0
+    with gzip_output(store, fn) as gz:
+        sink = SparseImageWriter(gz, sparse_plan.blocksize, sparse_plan.blocks, sparse_plan.runs)
+        for cmdline in chunk_commands(pi.devname, sparse_plan.blocksize, sparse_plan.runs):
+            if verify:
+                md5in, md5out = md5_fifo(pi)
+                adb.check_call(('shell','rm -f %s %s 2> /dev/null; mknod %s p' % (md5in, md5out, md5in)))
+                cmdline = md5_cmdline(pi, cmdline)
+            source, close = open_stream(adb, pi, transport, cmdline)
+            hasher = verify and AsyncHasher(md5())
+            for block in trace.source(source).blocks(hasher):
+                sink.write(block)
+                nbytes += len(block)
+                progress(nbytes)
+            close()
+            if verify:
+                check_device_md5(adb, pi, hasher.hexdigest(), ' in %s' % fn)
+        if not sink.complete():
+            raise RuntimeError("%s: device sent less data than expected" % fn)
+        progress.flush()
+        pbar.finish()
+    trace.streamed(t_open, nbytes)
 
-    child.wait()
-    if transport==adbxp.tcp:
-        s.close()
-        if not really_unforward(adb, port):
-            raise RuntimeError('could not remove ADB-forward for TCP port %d' % port)
+    with trace.phase('verify'):
+        if verify:
+            with open(fn+'.md5', 'w') as md5out:
+                print('%s *%s' % (gz.md5.hexdigest(), os.path.basename(fn)), file=md5out)
+
+def prepare_striped(adb, pi, bp, stripes, verify=True):
+    # Unmount the partition, and create a device-side command (and md5 FIFO) for each stripe
+    print("Saving partition %s (%s) as %d TCP stripes, %d MiB uncompressed..." % (pi.partname, pi.devname, stripes, pi.size/2048))
+    unmount_for_backup(adb, pi)
+
+    ranges = stripe_ranges(pi.size*512, stripes)
+    cmdlines = []
+    for k, (offset, length) in enumerate(ranges):
+        cmdline = 'dd if=/dev/block/%s bs=%d skip=%d count=%d 2> /dev/null' % (pi.devname, STRIPE_BS, offset//STRIPE_BS, (length+STRIPE_BS-1)//STRIPE_BS)
+        if verify:
+            md5in, md5out = md5_fifo(pi, k)
+            adb.check_call(('shell','rm -f %s %s 2> /dev/null; mknod %s p' % (md5in, md5out, md5in)))
+            cmdline = '{ md5sum %s > %s & %s | tee %s; wait; }' % (md5in, md5out, cmdline, md5in)
+        cmdlines.append(cmdline)
+    return ranges, cmdlines
+
+def backup_partition_striped(adb, pi, bp, ranges, cmdlines, verify=True, line_offset=0, store=None, trace=None):
+    # Receive each stripe on its own forwarded port, with positioned writes into a
+    # preallocated raw file which is compressed on the host as it fills in
+    trace = trace or PartitionTrace(bp.fn)
+    t_open = time.monotonic()
+    pbar = progress_bar(bp.fn, pi.size*512, line_offset)
+    progress = Throttle(pbar.update)
+    lock = threading.Lock()
+    received = [0]
+
+    def receive(k):
+        port = really_forward(adb, 5600+pi.partn+100*k, 5700+pi.partn+100*k)
+        if not port:
+            raise RuntimeError('%s: could not ADB-forward a TCP port for stripe %d' % (pi.partname, k))
+        child = None
+        try:
+            child = adb.pipe_out(('shell',tcp_cmdline(cmdlines[k], port)))
+            s = connect_ready(port, child)
+            h = md5()
+            with s:
+                for block in trace.source(Source(s.recv_into, s.fileno(), is_socket=True)).blocks():
+                    striped.pwrite(k, block)
+                    h.update(block)
+                    with lock:
+                        received[0] += len(block)
+                        progress(received[0])
+            child.wait()
+        finally:
+            # after a failure, stop the device-side command as open_stream does
+            if child and child.poll() is None:
+                child.terminate()
+                child.wait()
+            # a warning, so as not to hide why the stripe failed
+            if not really_unforward(adb, port):
+                print("WARNING: could not remove ADB-forward for TCP port %d" % port, file=stderr)
+        return h.hexdigest()
+
+    with gzip_output(store, bp.fn) as sink:
+        striped = StripedFile(bp.fn+'.raw', pi.size*512, ranges, sink)
+        try:
+            with ThreadPoolExecutor(len(ranges)) as pool:
+                localmd5s = list(pool.map(receive, range(len(ranges))))
+        finally:
+            striped.close()
+        for k, filled, length in striped.incomplete():
+            raise RuntimeError("%s: stripe %d is incomplete (%d of %d bytes)" % (bp.fn, k, filled, length))
+        progress.flush()
+        pbar.finish()
+        trace.streamed(t_open, received[0], parallel=len(ranges))
+
+    with trace.phase('verify'):
+        if verify:
+            # the stripes' md5s between them cover the whole image
+            for k, localmd5 in enumerate(localmd5s):
+                md5in, md5out = md5_fifo(pi, k)
+                devicemd5 = adb.check_output(('shell','cat %s && rm -f %s %s' % (md5out, md5in, md5out))).strip().split()[0]
+                if devicemd5 != localmd5:
+                    raise RuntimeError("%s: md5sum mismatch in stripe %d (local %s, device %s)" % (bp.fn, k, localmd5, devicemd5))
+            with open(bp.fn+'.md5', 'w') as md5out:
+                print('%s *%s' % (sink.md5.hexdigest(), os.path.basename(bp.fn)), file=md5out)
+
+def backup_all(adb, partmap, plan, transport, verify=True, jobs=1, host_gzip=False, incremental=None, chunksize=4<<20, store=None, stripes=1, tracer=None,
+               retries=0, resume=(), sparse=False, index=False, verify_chunks=False):
+    # incremental maps standard names of raw partitions to their previous backup directory (or None);
+    # resume is the standard names of partial backup files to resume (or redo)
+    incremental = incremental or {}
+    tracer = tracer or Tracer()
+    # a store chunks the raw stream, so it's always compressed on the host
+    host_gzip = host_gzip or bool(store)
+    # with sparse, raw images of filesystems only include their allocated blocks
+    sparse = set(standard for standard, bp in plan.items() if bp.taropts is None and standard not in incremental
+                 and partmap[standard].fstype in ('ext4', 'f2fs')) if sparse else set()
+    # with --tcp, other raw partitions can be striped across several streams
+    striped = set(standard for standard, bp in plan.items() if bp.taropts is None and standard not in incremental) \
+              if transport==adbxp.tcp and stripes > 1 else set()
+    # with verify_chunks, the rest are checked chunk by chunk as they arrive
+    chunked = set(standard for standard, bp in plan.items() if bp.taropts is None and standard not in incremental
+                  and standard not in sparse and standard not in striped) if verify_chunks else set()
+
+    # Largest partitions first, so that a small one doesn't trail behind a huge one
+    order = sorted(plan, key=lambda standard: partmap[standard].size, reverse=True)
+
+    def prepare(standard):
+        with tracer.partition(plan[standard].fn).phase('setup'):
+            if standard in incremental:
+                return prepare_incremental(adb, partmap[standard], plan[standard], incremental[standard], chunksize)
+            elif standard in striped:
+                return prepare_striped(adb, partmap[standard], plan[standard], stripes, verify)
+            elif standard in resume:
+                return None
+            elif standard in chunked:
+                return prepare_chunked(adb, partmap[standard], plan[standard])
+            elif standard in sparse:
+                sparse_plan = prepare_sparse(adb, partmap[standard], plan[standard], transport, retries)
+                if sparse_plan:
+                    return sparse_plan
+            return prepare_partition(adb, partmap[standard], plan[standard], verify, host_gzip)
+
+    # Device-side setup (mount/umount, md5 FIFO) runs one step ahead on its own thread:
+    # when a partition starts, the setup of the next one is submitted, so that it's
+    # ready to go as soon as a transfer slot frees up.
+    prep = ThreadPoolExecutor(1)
+    prepared = odict()
+    prep_lock = threading.Lock()
+    def prepared_for(ii):
+        with prep_lock:
+            for standard in order[len(prepared):ii+2]:
+                prepared[standard] = prep.submit(prepare, standard)
+            return prepared[order[ii]]
+
+    slots = queue.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+
+    def run(ii):
+        standard = order[ii]
+        slot = slots.get()
+        trace = tracer.partition(plan[standard].fn)
+        try:
+            setup = prepared_for(ii).result()
+            if standard in incremental:
+                backup_partition_incremental(adb, partmap[standard], plan[standard], transport,
+                                             setup, verify, line_offset=slot, store=store, trace=trace)
+            elif isinstance(setup, SparsePlan):
+                backup_partition_sparse(adb, partmap[standard], plan[standard], transport, setup,
+                                        verify, line_offset=slot, store=store, trace=trace)
+            elif standard in chunked:
+                backup_partition_chunked(adb, partmap[standard], plan[standard], transport, chunksize, retries,
+                                         line_offset=slot, store=store, trace=trace)
+            elif standard in striped:
+                backup_partition_striped(adb, partmap[standard], plan[standard], *setup,
+                                         verify=verify, line_offset=slot, store=store, trace=trace)
+            else:
+                backup_partition_retrying(adb, partmap[standard], plan[standard], transport, verify,
+                                          cmdline=setup, retries=retries, resume=standard in resume,
+                                          line_offset=slot, host_gzip=host_gzip, store=store, trace=trace, index=index)
+        finally:
+            slots.put(slot)
+
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = [pool.submit(run, ii) for ii in range(len(order))]
+        try:
+            for f in as_completed(futures):
+                f.result()
+        except BaseException:
+            with prep_lock:
+                for f in futures + list(prepared.values()):
+                    f.cancel()
+            raise
+        finally:
+            prep.shutdown()
 
 ########################################
 
 def main(args=None):
     p, args = parse_args(args)
     adb = AdbWrapper('adb', ('-s',args.specific) if args.specific else ('-d',))
+    adb.tracer = tracer = Tracer()
 
     # check adb version, and TWRP recovery
     adbversion = check_adb_version(p, adb)
     args.transport = sensible_transport(args.transport, adbversion)
     check_TWRP(p, adb, args.force)
+    if args.session:
+        try:
+            adb.start_session()
+        except (OSError, EOFError):
+            print("WARNING: could not start persistent adb shell session; falling back to one adb process per command", file=stderr)
+
+    serial = args.specific or adb.get_serialno()
+    if args.transport == 'auto':
+        args.transport = auto_transport(adb, adbversion, serial, args.rescan)
 
     # build partition map and backup plan
-    partmap = build_partmap(adb)
+    partmap = build_partmap(adb, serial=serial, rescan=args.rescan)
     plan = plan_backup(args)
     missing = set(plan) - set(partmap)
 
@@ -297,16 +977,67 @@ def main(args=None):
     elif missing:
         p.error("These non-standard partitions were requested for backup, but not found in the partition map: %s" % ', '.join(missing))
 
+    if args.jobs < 1:
+        p.error("--jobs must be at least 1")
+    if args.stripes < 1:
+        p.error("--stripes must be at least 1")
+    elif args.stripes > 1 and args.transport != adbxp.tcp:
+        print("WARNING: --stripes only works with --tcp transfers; ignoring it", file=stderr)
+    if args.chunk_size < 1:
+        p.error("--chunk-size must be at least 1 MiB")
+    if args.retries < 0:
+        p.error("--retries can't be negative")
+    if args.resume and (args.incremental is not None or args.stripes > 1):
+        p.error("--resume can't be combined with --incremental or --stripes")
+    if args.sparse and (args.incremental is not None or args.stripes > 1 or args.resume):
+        p.error("--sparse can't be combined with --incremental, --stripes or --resume")
+    if args.verify_chunks and (args.incremental is not None or args.stripes > 1 or args.resume or not args.verify):
+        p.error("--verify-chunks can't be combined with --incremental (which checks every chunk anyway), --stripes, --resume or --no-verify")
+
     if args.dry_run:
         p.exit()
 
-    # create backup directory
-    backupdir = create_backupdir(args)
-    os.chdir(backupdir)
+    # find previous backups for incremental raw images
+    incremental = None
+    if args.incremental is not None:
+        btype = 'nandroid' if args.nandroid else 'twrp'
+        incremental = {standard: (os.path.abspath(args.incremental) if args.incremental else
+                                  find_previous_backup(args.output_path, btype, bp.fn))
+                       for standard, bp in plan.items() if bp.taropts is None}
+        incremental = {standard: d and os.path.abspath(d) for standard, d in incremental.items()}
+
+    store = args.store and ChunkStore(os.path.abspath(args.store))
+    prometheus = args.prometheus and os.path.abspath(args.prometheus)
+
+    # create backup directory, or pick up where an interrupted backup left off
+    resume = set()
+    if args.resume:
+        backupdir = os.path.abspath(args.resume)
+        if not os.path.isdir(backupdir):
+            p.error("%s is not a directory" % args.resume)
+        os.chdir(backupdir)
+        for standard, bp in list(plan.items()):
+            if os.path.exists(bp.fn+'.md5'):
+                print("%s is already complete" % bp.fn, file=stderr)
+                del plan[standard]
+            elif os.path.exists(bp.fn):
+                resume.add(standard)
+    else:
+        backupdir = create_backupdir(args)
+        os.chdir(backupdir)
     print("Saving backup images in %s/ ..." % backupdir, file=stderr)
 
     # Okay, now it's time to actually... back up the partitions!
-    for standard, bp in plan.items():
-        backup_partition(adb, partmap[standard], bp, args.transport, args.verify)
+    try:
+        backup_all(adb, partmap, plan, args.transport, args.verify, args.jobs, args.host_gzip,
+                   incremental, args.chunk_size<<20, store, args.stripes, tracer, args.retries, resume, args.sparse, args.index,
+                   args.verify_chunks)
+    finally:
+        adb.close_session()
+        # timings of everything, including a failed backup
+        tracer.write_json('tetherback-trace.json')
+        if args.prometheus:
+            tracer.write_prometheus(prometheus)
 
     print("Backup complete.", file=stderr)
+    tracer.report()
@@ -0,0 +1,142 @@
+import os, time, json, threading, subprocess as sp
+from sys import stderr
+from contextlib import contextmanager
+from collections import OrderedDict as odict
+
+# Per-phase instrumentation: every adb invocation, and for each backup file the
+# time spent in setup (mount/umount, FIFOs, device-side hashing), waiting for the
+# first byte, streaming, and verify/teardown. While streaming, time spent waiting
+# for data from the device ("stall") is separated from time spent on the host
+# writing, hashing and compressing it, which shows where the bottleneck is.
+
+# fraction of streaming time spent waiting for the device, above which a transfer is device-bound
+DEVICE_BOUND = 0.5
+
+class PartitionTrace(object):
+    def __init__(self, name):
+        self.name = name
+        self.phases = odict()
+        self.sources = []
+        self.bytes = 0
+        self.stall = 0.0
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.monotonic() - t0
+
+    def source(self, source):
+        self.sources.append(source)
+        return source
+
+    def streamed(self, t_open, nbytes, parallel=1):
+        # called at the end of the stream, with the time when it was opened
+        # (for parallel streams, stall is the average over the streams)
+        now = time.monotonic()
+        first = min((s.first for s in self.sources if s.first is not None), default=now)
+        self.phases['first_byte'] = self.phases.get('first_byte', 0) + first - t_open
+        self.phases['streaming'] = self.phases.get('streaming', 0) + now - first
+        self.stall += sum(s.stall for s in self.sources) / parallel
+        self.bytes += nbytes
+        self.sources = []
+
+    def bound(self):
+        streaming = self.phases.get('streaming')
+        if streaming:
+            return 'device' if self.stall / streaming > DEVICE_BOUND else 'host'
+
+    def as_dict(self):
+        streaming = self.phases.get('streaming')
+        return dict(phases=self.phases, bytes=self.bytes, stall=self.stall,
+                    throughput=streaming and self.bytes / streaming / 1e6, bound=self.bound())
+
+class Tracer(object):
+    def __init__(self):
+        self.started = time.time()
+        self.t0 = time.monotonic()
+        self.lock = threading.Lock()
+        self.adb_events = []
+        self.partitions = odict()
+
+    @contextmanager
+    def adb(self, argv, session=False):
+        ev = dict(args=list(argv), start=time.monotonic() - self.t0, thread=threading.current_thread().name, session=session)
+        try:
+            yield ev
+        except sp.CalledProcessError as e:
+            ev['status'] = e.returncode
+            raise
+        finally:
+            ev['duration'] = time.monotonic() - self.t0 - ev['start']
+            with self.lock:
+                self.adb_events.append(ev)
+
+    def partition(self, name):
+        with self.lock:
+            return self.partitions.setdefault(name, PartitionTrace(name))
+
+    def adb_summary(self):
+        # total time and number of adb invocations, by device-side command
+        d = {}
+        for ev in self.adb_events:
+            args = ev['args']
+            key = args[0] if len(args) < 2 or args[0] not in ('shell', 'exec-out') else \
+                  '%s %s' % (args[0], (args[1].lstrip('({ ').split() or [''])[0])
+            n, t = d.get(key, (0, 0))
+            d[key] = (n + 1, t + ev['duration'])
+        return sorted(d.items(), key=lambda kv: -kv[1][1])
+
+    def bottleneck(self):
+        stall = sum(pt.stall for pt in self.partitions.values())
+        streaming = sum(pt.phases.get('streaming', 0) for pt in self.partitions.values())
+        if streaming:
+            return ('device' if stall / streaming > DEVICE_BOUND else 'host'), stall / streaming
+
+    def as_dict(self):
+        return dict(started=self.started, elapsed=time.monotonic() - self.t0,
+                    adb=self.adb_events, adb_summary=[dict(command=k, count=n, seconds=t) for k, (n, t) in self.adb_summary()],
+                    partitions=odict((name, pt.as_dict()) for name, pt in self.partitions.items()),
+                    bottleneck=(self.bottleneck() or (None,))[0])
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def write_prometheus(self, path):
+        # node_exporter textfile collector format; written atomically, as it requires
+        lines = ['# HELP tetherback_phase_seconds Time spent in each phase of backing up a file',
+                 '# TYPE tetherback_phase_seconds gauge']
+        for name, pt in self.partitions.items():
+            lines += ['tetherback_phase_seconds{file="%s",phase="%s"} %f' % (name, phase, t) for phase, t in pt.phases.items()]
+        for metric, help, attr in (('bytes', 'Bytes transferred from the device', 'bytes'),
+                                   ('stall_seconds', 'Time spent waiting for data from the device while streaming', 'stall')):
+            lines += ['# HELP tetherback_%s %s' % (metric, help), '# TYPE tetherback_%s gauge' % metric]
+            lines += ['tetherback_%s{file="%s"} %s' % (metric, name, getattr(pt, attr)) for name, pt in self.partitions.items()]
+        lines += ['# HELP tetherback_adb_seconds Time spent in adb invocations, by command',
+                  '# TYPE tetherback_adb_seconds gauge']
+        lines += ['tetherback_adb_seconds{command="%s"} %f' % (k.replace('\\', '\\\\').replace('"', '\\"'), t) for k, (n, t) in self.adb_summary()]
+        lines += ['# HELP tetherback_backup_seconds Duration of the whole backup',
+                  '# TYPE tetherback_backup_seconds gauge',
+                  'tetherback_backup_seconds %f' % (time.monotonic() - self.t0),
+                  '# HELP tetherback_backup_start_timestamp_seconds Start time of the backup',
+                  '# TYPE tetherback_backup_start_timestamp_seconds gauge',
+                  'tetherback_backup_start_timestamp_seconds %f' % self.started]
+        with open(path + '.tmp', 'w') as f:
+            print('\n'.join(lines), file=f)
+        os.replace(path + '.tmp', path)
+
+    def report(self, file=stderr):
+        for name, pt in self.partitions.items():
+            d = pt.as_dict()
+            print("  %s: %s%s" % (name, ', '.join('%s %.1fs' % kv for kv in pt.phases.items()),
+                                  '; %.1f MB/s while streaming, %s-bound' % (d['throughput'], d['bound']) if d['bound'] else ''), file=file)
+        n, t = len(self.adb_events), sum(ev['duration'] for ev in self.adb_events)
+        print("  %d adb commands took %.1fs in total; slowest: %s" % (n, t, ', '.join(
+            '%s (%dx, %.1fs)' % (k, n, t) for k, (n, t) in self.adb_summary()[:3])), file=file)
+        b = self.bottleneck()
+        if b:
+            print("  Bottleneck: %s (waited for the device %d%% of the streaming time)" % (
+                'the device or USB link' if b[0] == 'device' else 'the host', 100*b[1]), file=file)
@@ -0,0 +1,206 @@
+import os, sys, time, zlib, argparse, multiprocessing
+from sys import stderr
+from hashlib import md5
+from collections import OrderedDict as odict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tabulate import tabulate
+
+from .devcache import shared_cache_get, shared_cache_put
+from .restore import BACKUP_FN
+from .tetherback import progress_bar
+
+# Offline verification of backup directories: every backup file under the given
+# roots is checked against its .md5, on a pool of processes (largest files
+# first, so that the pool isn't left waiting for one big file at the end), with
+# one progress bar for the whole batch. With --gzip, gzipped files are also
+# decompressed in the same pass, which checks the CRC and length of each member.
+# The md5 (and gzip result) of each file is cached, keyed by its path, size,
+# mtime and inode, so unchanged files needn't be read again.
+
+READ_SIZE = 4<<20
+PROGRESS_EVERY = 64<<20
+# cached results are kept in a cache of their own (not tied to a device), under this name
+CACHE_NAME = 'verify'
+
+# bytes read by the worker processes so far, for the progress bar
+_progress = None
+
+def _init_worker(progress):
+    global _progress
+    _progress = progress
+
+def _report(n):
+    if _progress is not None:
+        with _progress.get_lock():
+            _progress.value += n
+
+class GzipTester(object):
+    '''Decompresses a (multi-member) gzip stream fed to update(), discarding the
+    output; zlib checks the CRC and length at the end of each member.'''
+
+    def __init__(self):
+        self.d = zlib.decompressobj(31)
+        self.partial = False        # in the middle of a member
+        self.error = None
+
+    def update(self, data):
+        try:
+            while data and not self.error:
+                self.partial = True
+                self.d.decompress(data, 1<<20)
+                if self.d.eof:
+                    data = self.d.unused_data
+                    self.d = zlib.decompressobj(31)
+                    self.partial = False
+                else:
+                    data = self.d.unconsumed_tail
+        except zlib.error as e:
+            self.error = "corrupt gzip data (%s)" % e
+
+    def result(self):
+        return self.error or ("truncated gzip data" if self.partial else True)
+
+def check_file(path, test_gzip=False):
+    # Returns (md5, gzip result): the latter is None if not tested, False if the
+    # file isn't gzipped, True if it's intact, or else an error message.
+    h, tester, first, unreported = md5(), None, True, 0
+    buf = bytearray(READ_SIZE)
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            data = memoryview(buf)[:n]
+            h.update(data)
+            if test_gzip and first and data[:2] == b'\x1f\x8b':
+                tester = GzipTester()
+            first = False
+            if tester:
+                tester.update(data)
+            unreported += n
+            if unreported >= PROGRESS_EVERY:
+                _report(unreported)
+                unreported = 0
+    _report(unreported)
+    return h.hexdigest(), tester.result() if tester else (False if test_gzip else None)
+
+def find_backup_files(roots):
+    # Yields (path of backup file, path of its .md5 or None), looking for the
+    # .md5 files written by tetherback (and TWRP), and for backup files without them
+    for root in roots:
+        if os.path.isfile(root):
+            yield root, root + '.md5' if os.path.exists(root + '.md5') else None
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            names = set(filenames)
+            for fn in sorted(filenames):
+                if fn.endswith('.md5'):
+                    yield os.path.join(dirpath, fn[:-4]), os.path.join(dirpath, fn)
+                elif BACKUP_FN.match(fn) and fn + '.md5' not in names:
+                    yield os.path.join(dirpath, fn), None
+
+def expected_md5(md5path):
+    # the md5sum in a .md5 file ("HASH *NAME" or "HASH  NAME"), or None
+    try:
+        with open(md5path) as f:
+            words = f.read().split()
+    except (OSError, UnicodeDecodeError):
+        return None
+    return words[0].lower() if words and len(words[0]) == 32 else None
+
+def verify_main(args=None):
+    p = argparse.ArgumentParser(prog='tetherback verify', description='''Check backup files against their .md5 files, using all CPU cores. Results are cached, so files which haven't changed since they were last checked aren't read again.''')
+    p.add_argument('roots', nargs='+', metavar='PATH', help="Backup directories, directories containing them (searched recursively), or backup files")
+    p.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, metavar='N', help="Check up to N files at once (default: number of CPUs, %(default)s)")
+    p.add_argument('-z', '--gzip', action='store_true', help="Also test the integrity of gzipped files, by decompressing them in the same pass as the md5sum")
+    p.add_argument('--rehash', action='store_true', help="Ignore cached results, and read every file")
+    p.add_argument('-v', '--verbose', action='store_true', help="List every file checked, not just problems")
+    args = p.parse_args(args)
+    if args.jobs < 1:
+        p.error("--jobs must be at least 1")
+
+    # status of each file: OK, FAILED, MISSING (.md5 but no file), NO MD5, STORED (in a --store repository), ERROR
+    results = odict()
+    todo, cached = [], 0
+    cache = {} if args.rehash else shared_cache_get(CACHE_NAME, 'files', {})
+    updated = dict(cache)
+    for path, md5path in find_backup_files(args.roots):
+        if md5path and not os.path.exists(path):
+            results[path] = ('STORED', "use 'tetherback reassemble' to check it") if os.path.exists(path + '.recipe') else ('MISSING', None)
+        elif not md5path:
+            results[path] = ('NO MD5', None)
+        else:
+            st = os.stat(path)
+            key, stamp = os.path.realpath(path), [st.st_size, st.st_mtime_ns, st.st_ino]
+            entry = cache.get(key)
+            if entry and entry['stamp'] == stamp and (entry['gzip'] is not None or not args.gzip):
+                results[path] = (entry['md5'], entry['gzip'])
+                cached += 1
+            else:
+                results[path] = None
+                todo.append((st.st_size, path, key, stamp))
+    if not results:
+        p.error("no backup files found in %s" % ', '.join(args.roots))
+
+    # biggest first
+    todo.sort(reverse=True)
+    total = sum(size for size, path, key, stamp in todo)
+    print("Checking %d files (%d MiB)%s..." % (len(todo), total>>20, ', and %d unchanged since they were last checked' % cached if cached else ''), file=stderr)
+    t0 = time.monotonic()
+    if todo:
+        progress = multiprocessing.Value('q', 0)
+        pbar = progress_bar('%d files' % len(todo), total or 1)
+        pool = ProcessPoolExecutor(min(args.jobs, len(todo)), initializer=_init_worker, initargs=(progress,))
+        try:
+            futures = {pool.submit(check_file, path, args.gzip): (path, key, stamp) for size, path, key, stamp in todo}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+                pbar.update(min(progress.value, pbar.max_value))
+                for future in done:
+                    path, key, stamp = futures[future]
+                    try:
+                        digest, gz = future.result()
+                    except OSError as e:
+                        results[path] = ('ERROR', str(e))
+                        continue
+                    results[path] = (digest, gz)
+                    updated[key] = dict(stamp=stamp, md5=digest, gzip=gz)
+            pbar.finish()
+        finally:
+            pool.shutdown(wait=False)
+            # keep whatever was done, even if interrupted
+            shared_cache_put(CACHE_NAME, 'files', updated)
+
+    # compare with the .md5 files (which may have changed, even if the backup files haven't)
+    summary = odict()
+    for path, result in results.items():
+        if result is None:
+            status, why = 'ERROR', 'not checked'
+        elif result[0] in ('STORED', 'MISSING', 'NO MD5', 'ERROR'):
+            status, why = result
+        else:
+            digest, gz = result
+            expected = expected_md5(path + '.md5')
+            if expected is None:
+                status, why = 'FAILED', "can't read %s.md5" % os.path.basename(path)
+            elif digest != expected:
+                status, why = 'FAILED', 'md5sum mismatch (file %s, expected %s)' % (digest, expected)
+            elif gz not in (None, False, True):
+                status, why = 'FAILED', gz
+            else:
+                status, why = 'OK', None
+        if status != 'OK' or args.verbose:
+            print('%s: %s%s' % (path, status, ' (%s)' % why if why else ''), file=stderr if status != 'OK' else sys.stdout)
+        count, size = summary.get(status, (0, 0))
+        summary[status] = (count + 1, size + (os.path.getsize(path) if os.path.exists(path) else 0))
+
+    if todo:
+        elapsed = time.monotonic() - t0
+        print("Checked %d MiB in %.1f s (%.1f MB/s)." % (total>>20, elapsed, total / elapsed / 1e6 if elapsed else 0), file=stderr)
+    print(tabulate([[status, count, size/(1<<20)] for status, (count, size) in summary.items()],
+                   ['Status', 'Files', 'MiB'], floatfmt='.1f'), file=stderr)
+    return 1 if set(summary) & {'FAILED', 'MISSING', 'ERROR'} else 0
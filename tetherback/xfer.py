@@ -0,0 +1,280 @@
+import os, sys, time, queue, threading, stat, select
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Low-overhead data path for backup streams:
+#  - readinto() into a small pool of reused buffers, with block size growing
+#    while reads keep filling the buffer
+#  - hashing on its own thread (hashlib releases the GIL), overlapping the writes
+#  - rate-limited progress bar updates
+#  - on Linux, splice() straight from the adb pipe or TCP socket into the output
+#    file, with the hash computed by reading back from the page cache
+
+MIN_BLOCK = 64<<10
+MAX_BLOCK = 1<<20
+NBUFS = 4
+
+can_splice = sys.platform.startswith('linux') and hasattr(os, 'splice')
+
+class Source(object):
+    '''Output of a device-side command. Pipes and sockets provide readinto (and fd,
+    for splicing); other transports only provide an iterator of blocks.'''
+
+    def __init__(self, readinto=None, fd=None, is_socket=False, block_iter=None, child=None):
+        self.readinto = readinto
+        self.fd = fd
+        self.is_socket = is_socket
+        self.block_iter = block_iter
+        self.child = child
+        # when the first data arrived, and time spent waiting for data after that
+        self.first = None
+        self.stall = 0.0
+
+        # Linux pipes default to 64 KiB, which caps every read (and splice) at that size
+        if fd is not None and not is_socket and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                if stat.S_ISFIFO(os.fstat(fd).st_mode):
+                    fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, MAX_BLOCK)
+            except OSError:
+                pass
+
+    def waited(self, t0):
+        # account for time spent waiting for data since t0
+        now = time.monotonic()
+        if self.first is None:
+            self.first = now
+        else:
+            self.stall += now - t0
+
+    def _readinto(self, buf):
+        t0 = time.monotonic()
+        n = self.readinto(buf)
+        self.waited(t0)
+        return n
+
+    def _block_iter(self):
+        while True:
+            t0 = time.monotonic()
+            block = next(self.block_iter, None)
+            self.waited(t0)
+            if block is None:
+                return
+            yield block
+
+    def kill(self):
+        # abandon a stalled transfer: reads then hit EOF
+        if self.child and self.child.poll() is None:
+            self.child.terminate()
+
+    def blocks(self, hasher=None):
+        # Yields memoryviews, which are only valid until the next iteration.
+        if self.readinto is None:
+            for block in self._block_iter():
+                yield block
+                if hasher:
+                    hasher.update(block)
+            return
+
+        if not hasher:
+            # no other consumer, so a single buffer will do
+            buf, size = bytearray(MAX_BLOCK), MIN_BLOCK
+            while True:
+                n = self._readinto(memoryview(buf)[:size])
+                if not n:
+                    break
+                elif n == size and size < MAX_BLOCK:
+                    size *= 2
+                yield memoryview(buf)[:n]
+            return
+
+        free = queue.Queue()
+        for ii in range(NBUFS):
+            free.put(bytearray(MAX_BLOCK))
+        size = MIN_BLOCK
+        while True:
+            buf = free.get()
+            n = self._readinto(memoryview(buf)[:size])
+            if not n:
+                break
+            elif n == size and size < MAX_BLOCK:
+                size *= 2
+            block = memoryview(buf)[:n]
+            yield block
+            # buffer goes back to the pool once it's been hashed
+            hasher.update(block, lambda buf=buf: free.put(buf))
+
+class AsyncHasher(object):
+    '''Feeds a hashlib object from a background thread.'''
+
+    def __init__(self, h):
+        self.h = h
+        self.q = queue.Queue(NBUFS)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.q.get()
+            if item is None:
+                break
+            data, done = item
+            try:
+                if not self.error:
+                    self.h.update(data)
+            except Exception as e:
+                self.error = e
+            if done:
+                done()
+
+    def update(self, data, done=None):
+        self.q.put((data, done))
+
+    def hexdigest(self):
+        if self.thread.is_alive():
+            self.q.put(None)
+            self.thread.join()
+        if self.error:
+            raise self.error
+        return self.h.hexdigest()
+
+class Tee(object):
+    '''hashlib-like object which also passes the data on to others; the digest is h's.'''
+
+    def __init__(self, h, *others):
+        self.h = h
+        self.others = others
+
+    def update(self, data):
+        self.h.update(data)
+        for o in self.others:
+            o.update(data)
+
+    def hexdigest(self):
+        return self.h.hexdigest()
+
+class Throttle(object):
+    '''Calls fn(value) at most once per interval seconds (and always on flush).'''
+
+    def __init__(self, fn, interval=0.25):
+        self.fn = fn
+        self.interval = interval
+        self.last = 0
+        self.value = None
+
+    def __call__(self, value):
+        self.value = value
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.fn(value)
+
+    def flush(self):
+        if self.value is not None:
+            self.fn(self.value)
+
+class RateLimit(object):
+    '''Caps the combined rate (bytes/s) of the transfers which share it, e.g. those
+    of all the devices on one USB bus. Thread-safe; call it with each block's size.'''
+
+    def __init__(self, rate, burst=0.25):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def __call__(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            # time at which the data sent so far would be "paid for", allowing a short burst
+            self.next = max(self.next, now - self.burst) + nbytes / self.rate
+            delay = self.next - now
+        if delay > 0:
+            time.sleep(delay)
+
+class TailHasher(object):
+    '''Hashes a file from a background thread, following behind a writer which
+    reports its progress with advance(); reads come from the page cache. The
+    writer's output starts at offset start in the file.'''
+
+    def __init__(self, h, path, start=0):
+        self.h = h
+        self.fd = os.open(path, os.O_RDONLY)
+        self.start = start
+        self.written = 0
+        self.finished = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        pos = 0
+        try:
+            while True:
+                with self.cond:
+                    while pos >= self.written and not self.finished:
+                        self.cond.wait()
+                    target, finished = self.written, self.finished
+                while pos < target:
+                    data = os.pread(self.fd, min(MAX_BLOCK, target - pos), self.start + pos)
+                    if not data:
+                        raise EOFError("output file is shorter than the data written to it")
+                    self.h.update(data)
+                    pos += len(data)
+                if finished and pos >= target:
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            os.close(self.fd)
+
+    def advance(self, written):
+        with self.cond:
+            self.written = written
+            self.cond.notify()
+
+    def hexdigest(self):
+        with self.cond:
+            self.finished = True
+            self.cond.notify()
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return self.h.hexdigest()
+
+def splice_to_file(source, out_fd, progress=None, hasher=None, limit=None):
+    # Moves the data from a pipe (or a socket, via an intermediate pipe) into
+    # out_fd without copying it through userspace. Returns the number of bytes.
+    total = 0
+    if source.is_socket:
+        pr, pw = os.pipe()
+    try:
+        while True:
+            # wait separately, to tell time spent waiting for the device from time spent writing
+            t0 = time.monotonic()
+            select.select([source.fd], [], [])
+            source.waited(t0)
+            if source.is_socket:
+                n = os.splice(source.fd, pw, MAX_BLOCK)
+                left = n
+                while left:
+                    left -= os.splice(pr, out_fd, left)
+            else:
+                n = os.splice(source.fd, out_fd, MAX_BLOCK)
+            if not n:
+                break
+            total += n
+            if limit:
+                limit(n)
+            if hasher:
+                hasher.advance(total)
+            if progress:
+                progress(total)
+    finally:
+        if source.is_socket:
+            os.close(pr)
+            os.close(pw)
+    return total